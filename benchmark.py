@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the processing stages on synthetic tweets or a real corpus.
+Every benchmark checks that the compared implementations return the same
+results.
+
+Usage: python benchmark.py [stage] [n_tweets] [corpus]
+
+stages: cleaning, scoring, parallel, distinct, scorers
+corpus: db for the tweets of geo_tweets_germany.db or a text file with one
+tweet per line, see tweet_texts. The default is synthetic tweets.
+"""
+import re
+import sys
+import multiprocessing
+import time
+import random
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from data_loader import load_tweets_from_db
+from data_processing import clean_text
+from data_processing import clean_texts
+from sentiment import check_scores
+from sentiment import distinct_scores
+from sentiment import parallel_scores
+from sentiment import scorers
+from sentiment import scoring_pool
+from sentiment import textblob_scores
+
+sample_words = ['Corona', 'Maske', 'Lockdown', 'heute', 'wieder', 'alle', 'Schule',
+                'great', 'bad', 'happy', 'schlimm', 'Unsinn', 'Ärzte', 'Straße',
+                'über', 'Impfung', 'Berlin', 'good', 'terrible', 'news', 'Test',
+                'U-Bahn', 'Uhr', 'RKI', 'Zahlen', 'Homeoffice', 'Kita']
+sample_decorations = ['@user_1', '@Jens_Spahn', '#Corona', '#StayHome', '😷', '🙏🏼',
+                      '🇩🇪', '❤️', 'https://t.co/AbC123xyz', 'http://bit.ly/x',
+                      '"Zitat"', '„Zitat“', ':', '\n', '\t', '  ', '_x', 'U+1F600']
+
+def synthetic_tweets(n, seed=0):
+    # tweets with mentions, hash tags, links, emoji and quotes in random
+    # positions, a fifth of them retweets
+    rng = random.Random(seed)
+    tweets = []
+    for _ in range(n):
+        tokens = [rng.choice(sample_words) for _ in range(rng.randint(5, 30))]
+        for _ in range(rng.randint(0, 6)):
+            tokens.insert(rng.randint(0, len(tokens)), rng.choice(sample_decorations))
+        text = ' '.join(tokens)
+        if rng.random() < 0.2:
+            text = f'RT @{rng.choice(sample_words)}: ' + text
+        tweets.append(text)
+    return pd.Series(tweets, dtype='str')
+
+def tweet_texts(n, corpus=None):
+    '''Raw texts of the first n tweets of a corpus.
+
+    Parameters
+    ----------
+    n : int
+        Number of tweets. Smaller corpora are used completely.
+    corpus : str, optional
+        'db' for the texts of the tweets table of geo_tweets_germany.db,
+        else the path of a text file with one tweet per line. The default
+        is None, n synthetic_tweets.
+
+    Returns
+    -------
+    texts : pandas Series of str
+
+    '''
+    if corpus is None:
+        return synthetic_tweets(n)
+    if corpus == 'db':
+        texts = load_tweets_from_db(columns=['text'])['text']
+    else:
+        with open(corpus, encoding='utf-8') as file:
+            texts = pd.Series(file.read().splitlines(), dtype='str')
+    return texts[:n].astype('str').reset_index(drop=True)
+
+def legacy_clean_text(text):
+    # cleanTxt of sentiment_analysis before the patterns were precompiled,
+    # kept as reference
+    text = re.sub('@[A-Za-z0–9]+', '', text)
+    text = re.sub('#', '', text)
+    text = re.sub(r'RT[\s]+', '', text)
+    text = re.sub(r'https?:\/\/\S+', '', text)
+    text = re.sub(': ', '', text)
+    text = re.sub('_[A-Za-z0–9]+', '', text)
+    text = re.sub(' +', ' ', text)
+    text = re.sub('U+[A-Za-z0–9]+', '', text)
+    emoj = re.compile("["
+        u"\U0001F600-\U0001F64F"
+        u"\U0001F300-\U0001F5FF"
+        u"\U0001F680-\U0001F6FF"
+        u"\U0001F1E0-\U0001F1FF"
+        u"\U00002500-\U00002BEF"
+        u"\U00002702-\U000027B0"
+        u"\U00002702-\U000027B0"
+        u"\U000024C2-\U0001F251"
+        u"\U0001f926-\U0001f937"
+        u"\U00010000-\U0010ffff"
+        u"\u2640-\u2642"
+        u"\u2600-\u2B55"
+        u"\u200d"
+        u"\u23cf"
+        u"\u23e9"
+        u"\u231a"
+        u"\ufe0f"
+        u"\u3030""]+", re.UNICODE)
+
+    text = re.sub(emoj, '', text)
+    text = re.sub('\n', ' ', text)
+    text = re.sub('\t', ' ', text)
+    text = re.sub('"', ' ', text)
+    text = re.sub('„', ' ', text)
+    text = re.sub('“', ' ', text)
+    return text.strip()
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - t0
+
+def report(name, n, seconds):
+    print(f'{name:<32} {seconds:8.3f} s {n / seconds:12,.0f} tweets/sec')
+
+def benchmark_cleaning(n=100000, corpus=None):
+    '''Tweets cleaned per second of the former per tweet cleaner and of
+    clean_text and clean_texts.'''
+    texts = tweet_texts(n, corpus)
+    n = len(texts)
+    expected, seconds = timed(lambda: texts.apply(legacy_clean_text))
+    report('legacy cleanTxt apply', n, seconds)
+
+    result, seconds = timed(lambda: texts.apply(clean_text))
+    report('clean_text apply', n, seconds)
+    assert result.equals(expected)
+
+    result, seconds = timed(clean_texts, texts)
+    report('clean_texts vectorized', n, seconds)
+    assert result.equals(expected)
+
+def legacy_textblob_scores(texts):
+    # the former two apply passes with a TextBlob per text and score
+    from textblob import TextBlob
+    subjectivity = texts.apply(lambda text: TextBlob(text).sentiment.subjectivity)
+    polarity = texts.apply(lambda text: TextBlob(text).sentiment.polarity)
+    return np.column_stack([polarity, subjectivity])
+
+def benchmark_scoring(n=100000, corpus=None):
+    '''Tweets scored per second of the former two TextBlob passes and of
+    textblob_scores.'''
+    texts = clean_texts(tweet_texts(n, corpus))
+    n = len(texts)
+    textblob_scores(texts[:1].tolist())  # load the lexicon
+    expected, seconds = timed(legacy_textblob_scores, texts)
+    report('legacy TextBlob two passes', n, seconds)
+
+    result, seconds = timed(textblob_scores, texts.tolist())
+    report('textblob_scores one pass', n, seconds)
+    assert np.array_equal(result, expected)
+
+def benchmark_parallel(n=100000, corpus=None):
+    '''Speedup of parallel_scores from 1 to the number of CPUs worker
+    processes over serial textblob_scores.'''
+    texts = clean_texts(tweet_texts(n, corpus)).tolist()
+    n = len(texts)
+    textblob_scores(texts[:1])
+    expected, serial_seconds = timed(textblob_scores, texts)
+    report('serial', n, serial_seconds)
+
+    for processes in range(1, multiprocessing.cpu_count() + 1):
+        with scoring_pool(textblob_scores, processes) as pool:
+            result, seconds = timed(parallel_scores, texts, textblob_scores, pool)
+        report(f'{processes} processes ({serial_seconds / seconds:.2f}x)', n, seconds)
+        assert np.array_equal(result, expected)
+
+def benchmark_distinct(n=100000, copies=0.5, corpus=None):
+    '''Tweets scored per second of textblob_scores and of distinct_scores
+    on tweets of which the share copies are copies of other tweets, like
+    retweets.'''
+    rng = np.random.default_rng(0)
+    texts = clean_texts(tweet_texts(n, corpus))
+    n = len(texts)
+    n_copies = int(n * copies)
+    texts[:n_copies] = texts.to_numpy()[rng.integers(n_copies, n, n_copies)]
+    texts = texts.tolist()
+    textblob_scores(texts[:1])
+    expected, seconds = timed(textblob_scores, texts)
+    report('textblob_scores all texts', n, seconds)
+
+    (result, n_distinct), seconds = timed(distinct_scores, texts, textblob_scores)
+    report(f'distinct_scores ({1 - n_distinct / n:.1%} duplicates)', n, seconds)
+    assert np.array_equal(result, expected)
+
+def benchmark_scorers(n=100000, batch_size=1000, corpus=None):
+    '''Throughput and batch latency of every registered scorer on the same
+    tweets, and the agreement of the polarities of every pair of scorers.
+    Scorers that cannot be loaded, e.g. without their lexicon file, are
+    skipped. Agreement on synthetic tweets says little about real tweets,
+    pass a corpus of collected tweets, see tweet_texts.'''
+    texts = clean_texts(tweet_texts(n, corpus)).tolist()
+    n = len(texts)
+    batches = [texts[i:i + batch_size] for i in range(0, n, batch_size)]
+    results = {}
+    for name, scorer in scorers.items():
+        try:
+            scorer(texts[:1])  # load the model
+        except FileNotFoundError as error:
+            print(f'{name:<32} skipped, {error}')
+            continue
+        scores, latencies = [], []
+        for batch in batches:
+            result, seconds = timed(scorer, batch)
+            scores.append(check_scores(result, len(batch)))
+            latencies.append(seconds * 1000)
+        results[name] = np.concatenate(scores)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        report(name, n, sum(latencies) / 1000)
+        print(f'{"":<32} batches of {batch_size}: p50 {p50:.1f} ms, '
+              f'p90 {p90:.1f} ms, p99 {p99:.1f} ms')
+
+    # agreement of the polarity: correlation, share of tweets with the same
+    # sign, i.e. negative, neutral or positive, and mean absolute difference
+    for (name_a, a), (name_b, b) in combinations(results.items(), 2):
+        polarity_a, polarity_b = a[:, 0], b[:, 0]
+        correlation = np.corrcoef(polarity_a, polarity_b)[0, 1]
+        same_sign = np.mean(np.sign(polarity_a) == np.sign(polarity_b))
+        difference = np.mean(np.abs(polarity_a - polarity_b))
+        print(f'{name_a} vs {name_b}: polarity correlation {correlation:.3f}, '
+              f'same sign {same_sign:.1%}, mean absolute difference {difference:.3f}')
+
+benchmarks = {'cleaning': benchmark_cleaning,
+              'scoring': benchmark_scoring,
+              'parallel': benchmark_parallel,
+              'distinct': benchmark_distinct,
+              'scorers': benchmark_scorers}
+
+if __name__ == '__main__':
+    stages = sys.argv[1:2] or list(benchmarks)
+    n_tweets = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    corpus = sys.argv[3] if len(sys.argv) > 3 else None
+    for stage in stages:
+        print(stage)
+        benchmarks[stage](n_tweets, corpus=corpus)
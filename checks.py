@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+"""
+Self checks of the collection and processing stages on small canned inputs,
+run against temporary files. Every check raises an AssertionError if a
+stage does not behave as documented.
+
+Usage: python checks.py [check]
+
+checks: replay, geocoder, collector, locations, writer, upserts, seen_ids,
+snapshot, partitions, score_cache
+"""
+import io
+import os
+import sys
+import gzip
+import json
+import tempfile
+from datetime import date
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from contextlib import redirect_stdout
+
+import dataset
+import numpy as np
+import pandas as pd
+
+import location_cache
+import replay_ingest
+import snapshot_cache
+from data_loader import SeenIds
+from geocoder import Geocoder
+from geocoder import fold
+from location_cache import LocationCache
+from partition_store import PartitionWriter
+from partition_store import compact_partitions
+from partition_store import compacted_prefix
+from partition_store import iter_tweets_from_partitions
+from partition_store import list_partitions
+from partition_store import load_tweets_from_partitions
+from partition_store import part_files
+from partition_store import partitions_state
+from replay_ingest import iter_archive
+from replay_ingest import replay_archives
+from score_cache import ScoreCache
+from sentiment import textblob_scores
+from tweet_store import BackgroundTweetWriter
+from tweet_store import TweetWriter
+from tweet_store import compact_tweets
+from tweet_store import create_id_index
+from tweet_store import extract_tweet_json
+from twitter_scraper import collect_tweets_concurrent
+
+def canned_status(id_str, location='Berlin', text='Corona heute', day=6):
+    # minimal raw API status with the fields of extract_tweet_json, created
+    # on a day of May 2020
+    return {'id_str': str(id_str),
+            'created_at': f'Wed May {day:02d} 12:34:56 +0000 2020',
+            'text': text,
+            'coordinates': None,
+            'retweet_count': 0,
+            'user': {'screen_name': f'user_{id_str}',
+                     'location': location,
+                     'description': '',
+                     'followers_count': 1,
+                     'created_at': 'Mon Jan 06 08:00:00 +0000 2014'}}
+
+def _kill_parser(path, batch_size):
+    # parser process killed, e.g. by the OOM killer
+    os._exit(1)
+
+def check_replay(tmp_dir):
+    '''Archives mixing single statuses, search responses, notices and broken
+    lines replay the statuses only, in pool and in single process mode.
+    Corrupt archives are skipped after their readable rows in both modes,
+    a killed parser process raises instead of blocking.'''
+    lines = [json.dumps(canned_status(1)),
+             '',
+             '{"broken',
+             json.dumps({'statuses': [canned_status(2), canned_status(3, location=''),
+                                      canned_status(4)],
+                         'search_metadata': {'max_id': 4, 'count': 3}}),
+             json.dumps({'delete': {'status': {'id': 5, 'id_str': '5'}}}),
+             json.dumps({'limit': {'track': 10}}),
+             json.dumps({'statuses': [], 'search_metadata': {}}),
+             json.dumps(canned_status(6))]
+    path = os.path.join(tmp_dir, 'mixed.jsonl.gz')
+    with gzip.open(path, 'wt', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    # status 3 has neither location nor coordinates
+    expected = ['1', '2', '4', '6']
+    assert [row['id_str'] for row in iter_archive(path)] == expected
+
+    # a complete gzip member followed by garbage
+    corrupt_path = os.path.join(tmp_dir, 'corrupt.jsonl.gz')
+    with open(corrupt_path, 'wb') as file:
+        file.write(gzip.compress((json.dumps(canned_status(7)) + '\n').encode()))
+        file.write(b'no gzip member')
+
+    for processes in [1, 2]:
+        db_file = os.path.join(tmp_dir, f'replay_{processes}.db')
+        db = dataset.connect(f'sqlite:///{db_file}')
+        with redirect_stdout(io.StringIO()):
+            rows = replay_archives([path, corrupt_path, path], db=db, processes=processes)
+        assert rows == 2 * len(expected) + 1
+        assert sorted(row['id_str'] for row in db['tweets'].all()) == expected + ['7']
+        db.close()
+
+    parse_archive = replay_ingest._parse_archive
+    replay_ingest._parse_archive = _kill_parser
+    db = dataset.connect(f"sqlite:///{os.path.join(tmp_dir, 'replay_killed.db')}")
+    try:
+        with redirect_stdout(io.StringIO()):
+            replay_archives([path, path], db=db, processes=2)
+    except BrokenProcessPool:
+        pass
+    else:
+        raise AssertionError('killed parser not reported')
+    finally:
+        replay_ingest._parse_archive = parse_archive
+        db.close()
+
+def check_geocoder(tmp_dir):
+    '''Common words, foreign and regional names of user locations stay
+    unmatched, spellings without umlauts or ß and doubled letters of city
+    names still match.'''
+    geocoder = Geocoder.from_csv()
+    expected = {'Planet Earth': None, 'Earth': None, 'Stadt': None, 'Am Rhein': None,
+                'Deutschland': None, 'überall': None,
+                'Schweiz': None, 'Schweden': None, 'Holland': None, 'Salzburg': None,
+                'Straßburg': None, 'Strasbourg': None, 'Sauerland': None,
+                'Irgendwo im Norden': None, 'Landkreis Harburg': None,
+                'Munchen': 'MÜNCHEN', 'Frankfurt': 'FRANKFURT AM MAIN',
+                'Berlin-Mitte, Germany': 'BERLIN', 'Bad Homburg': 'BAD HOMBURG VOR DER HÖHE',
+                'Hamburgg': 'HAMBURG', 'Stutgart': 'STUTTGART', 'Nuernberg': 'NÜRNBERG',
+                'Grosenhain': 'GROSSENHAIN', 'Großenhain': 'GROSSENHAIN'}
+    locations = fold(pd.Series(list(expected))).to_numpy(dtype=object)
+    positions = geocoder.match_distinct(locations)
+    cities = np.append(geocoder.cities.to_numpy(dtype=object), None)[positions]
+    assert dict(zip(expected, cities)) == expected
+
+def check_locations(tmp_dir):
+    '''Cached results, also negative ones, are reused by later instances of
+    the same version and dropped by another version.'''
+    geocoder = Geocoder.from_csv()
+    path = os.path.join(tmp_dir, 'locations.db')
+    locations = np.array(['Berlin', 'Schweiz', 'Planet Earth'], dtype=object)
+    expected = geocoder.match_distinct(locations)
+    assert list(expected[1:]) == [-1, -1]
+
+    cache = LocationCache(path, version='a')
+    assert list(cache.resolve(locations, geocoder)) == list(expected)
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    cache = LocationCache(path, version='a')
+    assert len(cache) == 3
+    assert list(cache.resolve(locations, geocoder)) == list(expected)
+    assert (cache.hits, cache.misses) == (3, 0)
+
+    cache = LocationCache(path, version='b')
+    assert len(cache) == 0
+    assert list(cache.resolve(locations, geocoder)) == list(expected)
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    # the version depends on location_cache_version
+    version = location_cache.cache_version()
+    location_cache.location_cache_version += '+'
+    try:
+        assert location_cache.cache_version() != version
+    finally:
+        location_cache.location_cache_version = location_cache.location_cache_version[:-1]
+
+def check_writer(tmp_dir):
+    '''Rows added to the background writer after a failed batch are written
+    by close(), none is lost.'''
+    db = dataset.connect(f"sqlite:///{os.path.join(tmp_dir, 'writer.db')}")
+    writer = BackgroundTweetWriter(db, batch_size=10, maxsize=20)
+    flush = writer.writer.flush
+    failures = [RuntimeError('injected flush failure')]
+
+    def failing_flush():
+        if failures:
+            raise failures.pop()
+        return flush()
+
+    writer.writer.flush = failing_flush
+    added = 0
+    try:
+        for i in range(200):
+            writer.add(extract_tweet_json(canned_status(i)))
+            added += 1
+    except RuntimeError:
+        pass
+    writer.close()
+    assert not failures and not writer.writer.buffer
+    assert db['tweets'].count() == writer.rows_written == added
+    db.close()
+
+def check_upserts(tmp_dir):
+    '''Tweets written again only refresh their mutable columns, compaction
+    of a table with duplicates keeps the first row with the latest mutable
+    columns and enables upserts.'''
+    db = dataset.connect(f"sqlite:///{os.path.join(tmp_dir, 'upserts.db')}")
+    row = extract_tweet_json(canned_status(1))
+    with TweetWriter(db) as writer:
+        writer.add(row)
+        writer.flush()
+        writer.add(dict(row, retweet_count=5, text='changed'))
+    rows = list(db['tweets'].all())
+    assert len(rows) == 1
+    assert (rows[0]['retweet_count'], rows[0]['text']) == (5, row['text'])
+
+    # a table written before upserts, with duplicates and no unique index
+    table = db['legacy']
+    table.insert_many([extract_tweet_json(canned_status(1)),
+                       extract_tweet_json(canned_status(2)),
+                       dict(extract_tweet_json(canned_status(1)), retweet_count=3),
+                       dict(extract_tweet_json(canned_status(1)), retweet_count=7)])
+    try:
+        create_id_index(db, 'legacy')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('duplicates not detected')
+    assert compact_tweets(db, 'legacy') == 2
+    rows = sorted(db['legacy'].all(), key=lambda row: row['id_str'])
+    assert [(row['id'], row['id_str'], row['retweet_count']) for row in rows] == \
+        [(1, '1', 7), (2, '2', 0)]
+    assert db['legacy'].has_index(['id_str'])
+    db.close()
+
+def check_seen_ids(tmp_dir):
+    '''SeenIds keeps the first occurrence of every id over all chunks, before
+    and after its recent ids are merged into the sorted array.'''
+    rng = np.random.default_rng(0)
+    # the first chunk is large enough to merge the recent ids, later chunks
+    # overlap earlier ones and repeat ids within the chunk
+    chunks = [rng.integers(0, 200000, 100000), rng.integers(150000, 250000, 20000),
+              rng.integers(0, 300000, 5000), np.array([7, 7, 300001, 300001])]
+    seen_ids = SeenIds()
+    seen = set()
+    for ids in chunks:
+        expected = []
+        for i in ids.tolist():
+            expected.append(i not in seen)
+            seen.add(i)
+        assert seen_ids.add_new(ids).tolist() == expected
+    assert len(seen_ids) == len(seen)
+
+class FakeStorage:
+    '''Stored tweets by position for the snapshot check, stands in for the
+    storage_state and process_tweets of snapshot_cache.'''
+    def __init__(self):
+        self.tweets = []
+        self.fingerprint = 'a'
+        self.calls = []
+
+    def add(self, *ids):
+        position = self.tweets[-1][0] if self.tweets else 0
+        self.tweets += [(position + i, str(id_str)) for i, id_str in enumerate(ids, 1)]
+
+    def storage_state(self, partitioned=False, position=None):
+        return (self.tweets[-1][0] if self.tweets else 0), self.fingerprint
+
+    def process_tweets(self, processes=1, scorer=None, partitioned=False, since=None,
+                       until=None, **kwargs):
+        self.calls.append((since, until))
+        ids = pd.Series([id_str for position, id_str in self.tweets
+                         if (since is None or position > since) and position <= until])
+        # tweets stored twice are read once, like from read_partition
+        ids = ids.drop_duplicates(keep='last').tolist()
+        return pd.DataFrame({'id_str': ids, 'polarity': np.zeros(len(ids))})
+
+def check_snapshot(tmp_dir):
+    '''The snapshot is reused while nothing was stored, new tweets are
+    appended, rewritten or removed tweets and pipeline changes rebuild it.'''
+    storage = FakeStorage()
+    patched = {'cache_dir': tmp_dir,
+               'storage_state': storage.storage_state,
+               'process_tweets': storage.process_tweets}
+    originals = {name: getattr(snapshot_cache, name) for name in patched}
+
+    def load():
+        storage.calls = []
+        with redirect_stdout(io.StringIO()):
+            df = snapshot_cache.load_enriched_tweets(output_columns=['id_str'])
+        return sorted(df['id_str'].astype(str)), storage.calls
+
+    for name, value in patched.items():
+        setattr(snapshot_cache, name, value)
+    try:
+        storage.add(1, 2, 3)
+        assert load() == (['1', '2', '3'], [(None, 3)])
+        assert load() == (['1', '2', '3'], [])
+
+        # appends only process the new positions, tweets already in the
+        # snapshot are not added again
+        storage.add(4, 2)
+        assert load() == (['1', '2', '3', '4'], [(3, 5)])
+
+        # compaction of the partitions changes the fingerprint
+        storage.fingerprint = 'b'
+        storage.add(6)
+        assert load() == (['1', '2', '3', '4', '6'], [(None, 6)])
+
+        # compact_tweets lowers the max rowid
+        storage.tweets = storage.tweets[:3]
+        assert load() == (['1', '2', '3'], [(None, 3)])
+
+        snapshot_cache.pipeline_version += '+'
+        assert load() == (['1', '2', '3'], [(None, 3)])
+    finally:
+        snapshot_cache.pipeline_version = snapshot_cache.pipeline_version.rstrip('+')
+        for name, value in originals.items():
+            setattr(snapshot_cache, name, value)
+
+def check_partitions(tmp_dir):
+    '''Tweets land in the partition of their day, date arguments only read
+    their days, tweets written twice are read once with the latest mutable
+    columns, and compaction merges the part files without changing the
+    tweets.'''
+    root = os.path.join(tmp_dir, 'partitions')
+    with PartitionWriter(root=root) as writer:
+        for i, day in enumerate([2, 2, 3, 4, 4, 4], 1):
+            writer.add(extract_tweet_json(canned_status(i, day=day)))
+        writer.flush()
+        writer.add(dict(extract_tweet_json(canned_status(1, day=2)), retweet_count=9))
+    days = [date(2020, 5, day) for day in [2, 3, 4]]
+    assert list_partitions(root) == days
+    assert [len(part_files(day, root)) for day in days] == [2, 1, 1]
+
+    def ids(df):
+        return sorted(df['id_str'].astype(int).tolist())
+
+    assert ids(load_tweets_from_partitions(root, query_date='2020-05-03')) == [3]
+    assert ids(load_tweets_from_partitions(root, start_date='2020-05-03',
+                                           exclude_dates=['2020-05-04'])) == [3]
+    df = load_tweets_from_partitions(root)
+    assert ids(df) == [1, 2, 3, 4, 5, 6]
+    assert df.loc[df['id_str'].astype(int) == 1, 'retweet_count'].tolist() == [9]
+    chunks = list(iter_tweets_from_partitions(chunksize=4, root=root))
+    assert [len(chunk) for chunk in chunks] == [4, 2]
+    assert ids(pd.concat(chunks)) == [1, 2, 3, 4, 5, 6]
+
+    # all days are older than today
+    state = partitions_state(root)
+    assert compact_partitions(older_than_days=0, root=root) == 3
+    assert compact_partitions(older_than_days=0, root=root) == 0
+    for day in days:
+        files = part_files(day, root)
+        assert len(files) == 1 and os.path.basename(files[0]).startswith(compacted_prefix)
+    assert partitions_state(root)[1] != state[1]
+    compacted = load_tweets_from_partitions(root)
+    assert ids(compacted) == [1, 2, 3, 4, 5, 6]
+    assert compacted.loc[compacted['id_str'].astype(int) == 1, 'retweet_count'].tolist() == [9]
+
+def check_score_cache(tmp_dir):
+    '''Cached scores are hits for the same id and cleaned text only, changed
+    texts are scored again and replace the cached score.'''
+    path = os.path.join(tmp_dir, 'scores.db')
+    scored = []
+
+    def score(texts):
+        scored.extend(texts)
+        return textblob_scores(texts)
+
+    texts = ['good news', 'bad news', 'good news']
+    cache = ScoreCache(path, version='a')
+    assert np.array_equal(cache.scores(['1', '2', '3'], texts, score), textblob_scores(texts))
+    assert (cache.hits, cache.misses, cache.scored) == (0, 3, 2)
+    assert sorted(scored) == ['bad news', 'good news']
+
+    # a new instance reads the stored scores, id 2 changed its text
+    scored.clear()
+    texts = ['good news', 'terrible news', 'good news']
+    cache = ScoreCache(path, version='a')
+    assert np.array_equal(cache.scores(['1', '2', '3'], texts, score), textblob_scores(texts))
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert scored == ['terrible news']
+
+    cache = ScoreCache(path, version='a')
+    assert np.array_equal(cache.scores(['2'], ['terrible news'], score),
+                          textblob_scores(['terrible news']))
+    assert (cache.hits, cache.misses, len(cache)) == (1, 0, 3)
+
+    # scores of other versions are never returned
+    cache = ScoreCache(path, version='b')
+    cache.scores(['1'], ['good news'], score)
+    assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+
+class FakeSearchAPI:
+    '''Search API of canned tweet ids per term, paged from newest to oldest
+    like the twitter search. Records the since_id of every request and the
+    ids returned per term.'''
+    def __init__(self, tweets):
+        self.tweets = tweets
+        self.since_ids = {term: set() for term in tweets}
+        self.returned = {term: set() for term in tweets}
+
+    def search(self, q, count=100, since_id=None, max_id=None, **kwargs):
+        ids = sorted((i for i in self.tweets[q]
+                      if (since_id is None or i > since_id)
+                      and (max_id is None or i <= max_id)), reverse=True)[:count]
+        self.since_ids[q].add(since_id)
+        self.returned[q].update(ids)
+        return [SimpleNamespace(id=i, _json=canned_status(i)) for i in ids]
+
+def check_collector(tmp_dir):
+    '''Concurrent collection pages every term to its end, writes tweets of
+    several terms once and later runs only fetch tweets above since_id.'''
+    db = dataset.connect(f"sqlite:///{os.path.join(tmp_dir, 'collector.db')}")
+    # three pages of the first term, the second overlaps it by 50 tweets
+    tweets = {'#Corona': list(range(1, 251)),
+              '#covid19': list(range(201, 351)),
+              'Pandemie': []}
+
+    def collect(api):
+        with redirect_stdout(io.StringIO()):
+            return collect_tweets_concurrent(api=api, db=db, terms=list(tweets),
+                                             rate=1000, burst=1000)
+
+    api = FakeSearchAPI(tweets)
+    assert collect(api) == 350
+    assert api.returned == {term: set(ids) for term, ids in tweets.items()}
+    assert db['tweets'].count() == 350
+
+    # new tweets of both terms, again overlapping
+    tweets['#Corona'] += list(range(400, 420))
+    tweets['#covid19'] += list(range(410, 430))
+    api = FakeSearchAPI(tweets)
+    assert collect(api) == 30
+    assert api.since_ids == {'#Corona': {250}, '#covid19': {350}, 'Pandemie': {None}}
+    assert api.returned == {'#Corona': set(range(400, 420)),
+                            '#covid19': set(range(410, 430)),
+                            'Pandemie': set()}
+    assert db['tweets'].count() == 380
+    db.close()
+
+checks = {'replay': check_replay,
+          'geocoder': check_geocoder,
+          'collector': check_collector,
+          'locations': check_locations,
+          'writer': check_writer,
+          'upserts': check_upserts,
+          'seen_ids': check_seen_ids,
+          'snapshot': check_snapshot,
+          'partitions': check_partitions,
+          'score_cache': check_score_cache}
+
+if __name__ == '__main__':
+    names = sys.argv[1:2] or list(checks)
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checks[name](tmp_dir)
+        print(name, 'ok')
@@ -1,18 +1,20 @@
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
 
+import numpy as np
 import pandas as pd
-import sqlite3
 
-def get_query_date_range(date_text: str):
-    '''Function to convert a date string to range of -1 and + 1 days in 
-    datetime format to limit sql search query date ranges for input date.
-    
+from database import reader
+
+def parse_date(date_text):
+    '''Function to convert a date string or date object to a date object.
+
     Parameters
     ----------
-    date_text : str
+    date_text : str or date
         date string as input. Allowed to following formats:
-        ('%Y-%m-%d', '%d.%m.%Y', '%Y/%m/%d', '%d/%m/%Y')
+        ('%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d', '%d/%m/%Y')
 
     Raises
     ------
@@ -21,40 +23,360 @@ def get_query_date_range(date_text: str):
 
     Returns
     -------
-    query_date_min : datetime object
-        input date -1 days
-    query_date_max : datetime object
-        input date +1 days
+    date object
 
     '''
-    # Controls for different datetime formats and converts to sqlite3 database
-    # format '%Y-%m-%d'
+    if isinstance(date_text, datetime):
+        return date_text.date()
+    if isinstance(date_text, date):
+        return date_text
+    
+    # Controls for different datetime formats
     for fmt in ('%Y-%m-%d','%d-%m-%Y', '%d.%m.%Y', '%Y/%m/%d', '%d/%m/%Y'):
         try:
-            query_date = datetime.strptime(date_text, fmt).date()
-            query_date.strftime('%Y-%m-%d')
-            
-            # calculates date ranges required for sql query
-            query_date_min = query_date
-            query_date_max = query_date + timedelta(days=1)
-
-            return "'" + str(query_date_min) + "'", "'" + str(query_date_max) + "'"
-        
+            return datetime.strptime(date_text, fmt).date()
         except ValueError:
             pass
         
     raise ValueError('no valid date format found')
 
+# dates excluded from the full dataset
+excluded_dates = ['2020-04-30', '2020-05-01', '2020-05-06']
+
+# columns loaded by default
+tweet_columns = ['created',
+                 'user_name',
+                 'user_location',
+                 'text',
+                 'id_str',
+                 'retweet_count',
+                 'user_followers',
+                 'coordinates']
+
+# all columns that can be selected with the columns argument
+selectable_columns = tweet_columns + ['user_description',
+                                      'user_created',
+                                      'created_date']
+
+def date_intervals(start_date=None, end_date=None, exclude_dates=()):
+    '''Split the inclusive range start_date to end_date into the intervals
+    of days that remain after removing exclude_dates.
+
+    Returns
+    -------
+    list of tuple
+        (first, last) date pairs, None for an unbounded side.
+
+    '''
+    intervals = [(start_date, end_date)]
+    for day in sorted(set(exclude_dates)):
+        split = []
+        for first, last in intervals:
+            if (first is not None and day < first) or (last is not None and day > last):
+                split.append((first, last))
+                continue
+            # cut the excluded day out, drop intervals that become empty
+            if first is None or first < day:
+                split.append((first, day - timedelta(days=1)))
+            if last is None or day < last:
+                split.append((day + timedelta(days=1), last))
+        intervals = split
+    return intervals
+
+def date_filter_clause(start_date=None, end_date=None, exclude_dates=()):
+    '''Build a where clause that selects the days from start_date to
+    end_date without exclude_dates as OR-ed ranges on the created_date
+    index, e.g. created_date < ? OR created_date BETWEEN ? AND ?, instead
+    of a date(created) != ... test for every row.
+
+    Parameters
+    ----------
+    start_date, end_date : date, optional
+        Inclusive date range, None for no limit.
+    exclude_dates : list of date, optional
+        Excluded days.
+
+    Returns
+    -------
+    clause : str
+        SQL condition with ? placeholders.
+    params : list of str
+        '%Y-%m-%d' parameters bound to the placeholders.
+
+    '''
+    ranges, params = [], []
+    for first, last in date_intervals(start_date, end_date, exclude_dates):
+        if first is not None and last is not None:
+            ranges.append('created_date BETWEEN ? AND ?')
+            params.extend([str(first), str(last)])
+        elif first is not None:
+            ranges.append('created_date >= ?')
+            params.append(str(first))
+        elif last is not None:
+            ranges.append('created_date <= ?')
+            params.append(str(last))
+        else:
+            ranges.append('1')
+    
+    # every day in the range is excluded
+    if not ranges:
+        return '0', []
+    return '(' + ' OR '.join(ranges) + ')', params
+
+def build_tweet_query(start_date=None, end_date=None, exclude_dates=(),
+                      columns=None, min_rowid=None, max_rowid=None,
+                      table_name='tweets'):
+    '''Build one parameterized select statement for a date range, excluded
+    days and a column projection.
+
+    Parameters
+    ----------
+    start_date, end_date : str or date, optional
+        Inclusive date range, None for no limit.
+    exclude_dates : list of str or date, optional
+        Excluded days.
+    columns : list of str, optional
+        Selected columns, see selectable_columns. The default is
+        tweet_columns.
+    min_rowid, max_rowid : int, optional
+        Only rows with min_rowid < rowid <= max_rowid, e.g. to load the rows
+        written since an earlier load.
+
+    Raises
+    ------
+    ValueError
+        Value error for unknown columns or date formats.
+
+    Returns
+    -------
+    sql : str
+        Select statement with ? placeholders.
+    params : list of str
+        Parameters bound to the placeholders.
+
+    '''
+    columns = columns or tweet_columns
+    unknown = [column for column in columns if column not in selectable_columns]
+    if unknown:
+        raise ValueError(f'unknown columns {unknown}')
+    
+    start_date = parse_date(start_date) if start_date is not None else None
+    end_date = parse_date(end_date) if end_date is not None else None
+    where, params = date_filter_clause(start_date, end_date,
+                                       [parse_date(day) for day in exclude_dates])
+    if min_rowid is not None:
+        where += ' AND rowid > ?'
+        params.append(min_rowid)
+    if max_rowid is not None:
+        where += ' AND rowid <= ?'
+        params.append(max_rowid)
+    
+    sql = f'''SELECT {', '.join(columns)}
+             FROM {table_name} WHERE {where}'''
+    return sql, params
+
+def explain_query(conn, sql, params=()):
+    # return the detail lines of the sqlite query plan, e.g.
+    # 'SEARCH tweets USING INDEX ix_tweets_created_date (created_date>? AND created_date<?)'
+    return [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def has_unique_id_index(conn, table_name='tweets'):
+    '''Check if the tweets table has a unique index on id_str, i.e. it was
+    written with upserts and contains no duplicate tweets.'''
+    for index in conn.execute(f'PRAGMA index_list({table_name})').fetchall():
+        # index_list rows: seq, name, unique, origin, partial
+        if not index[2]:
+            continue
+        columns = [info[2] for info in conn.execute(f'PRAGMA index_info({index[1]})')]
+        if columns == ['id_str']:
+            return True
+    return False
+
+# longitude and latitude of the GeoJSON points in the coordinates column,
+# e.g. {"type": "Point", "coordinates": [13.405, 52.52]}
+coordinates_pattern = r'"coordinates":\s*\[\s*([-+.\deE]+)\s*,\s*([-+.\deE]+)\s*\]'
+
+def parse_coordinates(df):
+    '''Replace the geotag JSON of the coordinates column by the float
+    columns tweet_longitude and tweet_latitude, NaN for tweets without
+    geotag. All rows are parsed in one vectorized pass.
+
+    Parameters
+    ----------
+    df : pandas DataFrame object.
+        Tweet frame, returned unchanged without coordinates column.
+
+    Returns
+    -------
+    df : pandas DataFrame object.
+
+    '''
+    if 'coordinates' not in df.columns:
+        return df
+    points = df['coordinates'].astype(object).astype('string').str.extract(coordinates_pattern)
+    df = df.drop(columns='coordinates')
+    df['tweet_longitude'] = pd.to_numeric(points[0], errors='coerce').astype('float64')
+    df['tweet_latitude'] = pd.to_numeric(points[1], errors='coerce').astype('float64')
+    return df
+
+# compact in-memory dtypes of the tweet frame. Repeated strings become
+# categoricals, counts and coordinates get narrower widths
+category_columns = ['user_name', 'user_location', 'user_location_cleaned', 'state']
+narrow_dtypes = {'retweet_count': 'int32',
+                 'user_followers': 'int32',
+                 'longitude': 'float32',
+                 'latitude': 'float32',
+                 'tweet_longitude': 'float32',
+                 'tweet_latitude': 'float32',
+                 'subjectivity': 'float32',
+                 'polarity': 'float32'}
+
+def memory_usage_mb(df):
+    # deep memory usage per column in MB, including python string objects
+    return df.memory_usage(deep=True, index=False) / 1024**2
+
+def compact_dtypes(df, report=False):
+    '''Convert the tweet frame to compact dtypes: categorical user and city
+    columns, int32 counts, float32 coordinates and scores, created as
+    datetime64 and id_str as int64. Columns missing in df are skipped.
+
+    Parameters
+    ----------
+    df : pandas DataFrame object.
+        Tweet frame.
+    report : bool, optional
+        Print the memory usage per column before and after. The default is
+        False.
+
+    Returns
+    -------
+    df : pandas DataFrame object.
+        Compacted copy of the tweet frame.
+
+    '''
+    if report:
+        before = memory_usage_mb(df)
+        before_dtypes = df.dtypes.astype(str)
+    
+    df = df.copy()
+    for column in category_columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    for column, dtype in narrow_dtypes.items():
+        if column in df.columns:
+            # counts can be NULL in the database
+            if dtype.startswith('int'):
+                df[column] = df[column].fillna(0)
+            df[column] = df[column].astype(dtype)
+    if 'created' in df.columns:
+        df['created'] = pd.to_datetime(df['created'])
+    if 'id_str' in df.columns:
+        df['id_str'] = df['id_str'].astype('int64')
+    
+    if report:
+        after = memory_usage_mb(df)
+        print(pd.DataFrame({'dtype before': before_dtypes,
+                            'MB before': before.round(2),
+                            'dtype after': df.dtypes.astype(str),
+                            'MB after': after.round(2)}))
+        print(f'total {before.sum():.2f} MB -> {after.sum():.2f} MB')
+    return df
+
+class SeenIds:
+    '''Compact set of int64 tweet ids for deduplication across chunks.
+
+    Ids are kept in a large sorted numpy array plus a small sorted array of
+    recently added ids. Lookups are binary searches, the small array is
+    merged into the large one once it grows past a quarter of its size, so
+    the cost of merging stays amortized. 8 bytes per id instead of a
+    python set of id strings.
+    '''
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.recent = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    @staticmethod
+    def _contains(sorted_ids, ids):
+        if not len(sorted_ids):
+            return np.zeros(len(ids), dtype=bool)
+        positions = np.searchsorted(sorted_ids, ids)
+        positions[positions == len(sorted_ids)] = 0
+        return sorted_ids[positions] == ids
+
+    def add_new(self, ids):
+        '''Add ids and return a mask of the ids that were not seen before,
+        repeated ids within ids only count at their first occurrence.'''
+        ids = np.asarray(ids, dtype=np.int64)
+        new = ~(self._contains(self.ids, ids) | self._contains(self.recent, ids))
+        new &= ~pd.Series(ids).duplicated().to_numpy()
+        
+        self.recent = np.union1d(self.recent, ids[new])
+        if len(self.recent) > max(len(self.ids) // 4, 65536):
+            self.ids = np.union1d(self.ids, self.recent)
+            self.recent = np.empty(0, dtype=np.int64)
+        return new
+
+def resolve_date_arguments(kwargs):
+    '''Resolve the date arguments of the loaders, see load_tweets_from_db.
+
+    Returns
+    -------
+    start_date, end_date : str or date
+        Inclusive date range, None for no limit.
+    exclude_dates : list
+        Excluded days.
+
+    '''
+    # get optional arguments for the date range. A query_date selects a
+    # single day
+    query_date = kwargs.get('query_date', None)
+    start_date = kwargs.get('start_date', query_date)
+    end_date = kwargs.get('end_date', query_date)
+    
+    # the full dataset leaves out excluded_dates by default
+    if start_date is None and end_date is None:
+        exclude_dates = kwargs.get('exclude_dates', excluded_dates)
+    else:
+        exclude_dates = kwargs.get('exclude_dates', [])
+    return start_date, end_date, exclude_dates
+
+def _prepare_query(conn, kwargs):
+    # build the select statement for the loader keyword arguments, see
+    # load_tweets_from_db
+    start_date, end_date, exclude_dates = resolve_date_arguments(kwargs)
+    sql, params = build_tweet_query(start_date, end_date, exclude_dates,
+                                    kwargs.get('columns', None),
+                                    kwargs.get('min_rowid', None),
+                                    kwargs.get('max_rowid', None))
+    if kwargs.get('explain', False):
+        print('\n'.join(explain_query(conn, sql, params)))
+    return sql, params
+
 def load_tweets_from_db(**kwargs):
     '''Function to retrieve twitter data from sqlite3 database with optional
-    argument for 
+    arguments for date ranges, excluded days and selected columns. All
+    filters are combined to one parameterized query on the created_date
+    index.
     
 
     Parameters
     ----------
-    **kwargs : query_date str.
+    **kwargs : query_date str, start_date str, end_date str,
+               exclude_dates list, columns list, min_rowid int,
+               max_rowid int, explain bool, compact bool.
         Use query_date argument to add date string for desired date of tweet 
-        data.
+        data. Use start_date and end_date for an inclusive date range and
+        exclude_dates for days left out of it. Without any date argument
+        all tweets except excluded_dates are loaded. columns selects the
+        loaded columns, the default is tweet_columns. The coordinates
+        column is loaded as tweet_longitude and tweet_latitude, see
+        parse_coordinates. min_rowid and
+        max_rowid limit the rowid range (exclusive, inclusive). Set explain
+        to True to print the sqlite query plan. compact converts the frame
+        with compact_dtypes, the default is True.
 
     Returns
     -------
@@ -62,49 +384,64 @@ def load_tweets_from_db(**kwargs):
         Returns the dataframe object for the data base or query date.
 
     '''
-    # connect to sqlite3 db and cursor
-    conn = sqlite3.connect("geo_tweets_germany.db")
-    c = conn.cursor()
-    
-    # get optional arguments for query_date
-    query_date = kwargs.get('query_date', None)
+    # borrow a pooled read-only connection, the scraper can keep writing
+    with reader() as conn:
+        sql, params = _prepare_query(conn, kwargs)
+        df = pd.read_sql_query(sql, conn, params=params)
+        
+        # databases written with upserts are unique on id_str already
+        unique_ids = has_unique_id_index(conn)
     
-    # if query_date is True, get query_date_min and query_date_max range from
-    # the get_query_date_range function from utils
-    if query_date:
-        query_date_min, query_date_max = get_query_date_range(query_date)
-        df = pd.read_sql_query(f'''SELECT
-                               created,
-                               user_name,
-                               user_location,
-                               text,
-                               id_str,
-                               retweet_count,
-                               user_followers
-                               FROM tweets WHERE created >
-                               {query_date_min} AND created <
-                               {query_date_max}''', conn)
-    elif not query_date:
-        df = pd.read_sql_query('''SELECT
-                               created,
-                               user_name,
-                               user_location,
-                               text,
-                               id_str,
-                               retweet_count,
-                               user_followers
-                               FROM tweets WHERE date(created) != "2020-05-06"
-                               AND date(created) != "2020-04-30"
-                               AND date(created) != "2020-05-01"
-                               ''', conn)
-    # close connection and return dataframe filtered for date
-    c.close()
-    conn.close()
+    # easy way to remove duplicats based on twitter id_str for databases
+    # that were not compacted yet
+    if not unique_ids and 'id_str' in df.columns:
+        df.drop_duplicates(subset='id_str', keep="first", inplace=True)
     
-    # easy way to remove duplicats based on twitter id_str 
-    df.drop_duplicates(subset='id_str', keep="first", inplace=True)
+    df = parse_coordinates(df)
+    if kwargs.get('compact', True):
+        df = compact_dtypes(df)
     return df
 
-if __name__ == '__main__':
-    df = load_tweets_from_db()
+def iter_tweets_from_db(chunksize=50000, **kwargs):
+    '''Generator version of load_tweets_from_db yielding DataFrames of at
+    most chunksize rows, so peak memory does not grow with the database.
+
+    Parameters
+    ----------
+    chunksize : int, optional
+        Maximum number of rows per chunk. The default is 50000.
+    **kwargs :
+        Same arguments as load_tweets_from_db.
+
+    Yields
+    ------
+    df : pandas DataFrame object.
+        Chunk of tweets with an index continuing over all chunks. Tweets
+        already yielded in an earlier chunk are dropped.
 
+    '''
+    # the whole stream reads one consistent snapshot of the database
+    with reader() as conn:
+        sql, params = _prepare_query(conn, kwargs)
+        
+        # only databases that were not compacted need deduplication
+        seen_ids = None
+        if not has_unique_id_index(conn) and 'id_str' in (kwargs.get('columns') or tweet_columns):
+            seen_ids = SeenIds()
+        
+        offset = 0
+        for df in pd.read_sql_query(sql, conn, params=params, chunksize=chunksize):
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            offset += len(df)
+            
+            if seen_ids is not None:
+                df = df[seen_ids.add_new(df['id_str'].astype('int64').to_numpy())]
+            df = parse_coordinates(df)
+            if kwargs.get('compact', True):
+                df = compact_dtypes(df)
+            if len(df):
+                yield df
+
+if __name__ == '__main__':
+    df = load_tweets_from_db(compact=False)
+    df = compact_dtypes(df, report=True)
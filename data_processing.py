@@ -1,123 +1,137 @@
-import os
-
 import pandas as pd
 import numpy as np
 
-from textblob import TextBlob
 import re
+from functools import partial
 
-from utils import resources_dir
+from geocoder import get_geocoder
+from location_cache import get_location_cache
+from score_cache import get_score_cache
+from state_join import add_states
+from sentiment import check_scores
+from sentiment import distinct_scores
+from sentiment import parallel_scores
+from sentiment import score_columns
+from sentiment import textblob_scores
 
 from data_loader import load_tweets_from_db
 
 def add_coordinates_to_location(df):
     
-    # load twitter data. Assign longitude and latitude columns to data frame
-    # cleanup user_location column for data processing
-    #df = pd.read_csv(os.path.join(resources_dir, '200506_geo_tweets_germany.csv'))
-    #df['longitude'] = np.nan
-    #df['latitude'] = np.nan
-    df.loc[:, 'user_location'].replace(' ', np.nan, inplace=True)
-    df.loc[:, 'user_location'] = df.loc[:, 'user_location'].astype(str)
-    df = df.copy()
-    
-    # cleanup strings in user_location column. Split the strings and use first
-    # city name and convert it to uppercase. Save new column as a new column
-    # user_location_cleaned containing only the city names
-    df_loc_split = df.loc[:, 'user_location'].str.split(",", expand=True)
-    df_loc_split = df_loc_split[0].str.upper()
-    df.loc[:, 'user_location_cleaned'] = df_loc_split
-    df = df.copy()
-    
-    # load df_geo as data frame containing all german city data with longitude
-    # and latitude and filter twitter data frame against german cities found 
-    # in the geodata_german_cities.csv, save as df_loc_cleaned
-    df_geo = pd.read_csv(os.path.join(resources_dir, 'geodata_german_cities.csv'))
-    df_loc_cleaned = df.loc[df.loc[:, 'user_location_cleaned'].isin(df_geo.loc[:, 'City'])]
-    df_loc_cleaned = df_loc_cleaned.copy()
-    
-    # create lists of city, long and lat data to create dicts for city:long or 
-    # city: lat for filtering longitude, latitude data against city name 
-    city_list = df_geo.loc[:, 'City'].tolist()
-    longitude_list = df_geo.loc[:, 'longitude'].tolist() 
-    latitude_list = df_geo.loc[:, 'latitude'].tolist()
-    city_dict_longitude = dict(zip(city_list, longitude_list))
-    city_dict_latitude = dict(zip(city_list, latitude_list))
-    
-    # map against city_dict_longitude and city_dict_latitude to add to
-    # these columns the long, lat information based on city name
-    df_loc_cleaned.loc[:, 'longitude'] = df_loc_cleaned.loc[:, 'user_location_cleaned'].map(city_dict_longitude)
-    df_loc_cleaned = df_loc_cleaned.copy()
-    df_loc_cleaned.loc[:, 'latitude'] = df_loc_cleaned.loc[: ,'user_location_cleaned'].map(city_dict_latitude)
-    df_loc_cleaned = df_loc_cleaned.copy()
-    #df_loc_cleaned.to_csv(os.path.join(resources_dir, '200506_geo_tweets_germany.csv'), header=True, index=True)
-    
-    return df_loc_cleaned
+    # resolve the user_location column against the german cities of 
+    # geodata_german_cities.csv, see geocoder.Geocoder for the matching.
+    # Only tweets with matched cities are kept, user_location_cleaned,
+    # longitude and latitude are added in one pass over the distinct
+    # locations. Locations resolved by earlier runs are taken from the
+    # persistent location cache
+    return get_geocoder().add_coordinates(df, cache=get_location_cache())
 
-def sentiment_analysis(df):
-    
-    def cleanTxt(text):
-        text = re.sub('@[A-Za-z0–9]+', '', text) #Removing @mentions
-        text = re.sub('#', '', text) # Removing '#' hash tag
-        text = re.sub('RT[\s]+', '', text) # Removing RT
-        text = re.sub('https?:\/\/\S+', '', text) # Removing hyperlink
-        text = re.sub(': ', '', text)
-        text = re.sub('_[A-Za-z0–9]+', '', text)
-        text = re.sub(' +', ' ', text)
-        text = re.sub('U+[A-Za-z0–9]+', '', text)
-        
-        emoj = re.compile("["
-            u"\U0001F600-\U0001F64F"  # emoticons
-            u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-            u"\U0001F680-\U0001F6FF"  # transport & map symbols
-            u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-            u"\U00002500-\U00002BEF"  # chinese char
-            u"\U00002702-\U000027B0"
-            u"\U00002702-\U000027B0"
-            u"\U000024C2-\U0001F251"
-            u"\U0001f926-\U0001f937"
-            u"\U00010000-\U0010ffff"
-            u"\u2640-\u2642" 
-            u"\u2600-\u2B55"
-            u"\u200d"
-            u"\u23cf"
-            u"\u23e9"
-            u"\u231a"
-            u"\ufe0f"  # dingbats
-            u"\u3030""]+", re.UNICODE)
-        
-        text = re.sub(emoj, '', text)
-        text = re.sub('\n', ' ', text)
-        text = re.sub('\t', ' ', text)
-        text = re.sub('"', ' ', text)
-        text = re.sub('„', ' ', text)
-        text = re.sub('“', ' ', text)
-        text = text.strip()
-        
-        return text
-    
-    # Clean the tweets
-    df['text'] = df['text'].apply(cleanTxt)
+# characters of the tweet cleaning patterns. Note that the word class is
+# written with an en dash instead of a hyphen, so it only holds the digits 0
+# and 9. It is kept as is so cleaned texts do not change. Whitespace is
+# listed explicitly, \s of pandas' pyarrow regex engine only matches ascii
+# whitespace
+word_chars = 'A-Za-z0–9'
+whitespace = ''.join(chr(c) for c in range(0x3001) if chr(c).isspace())
+emoji_chars = ('\u200d\u231a\u23cf\u23e9'
+               '\u24c2-\U0001f251'
+               '\U00010000-\U0010ffff')
+
+# cleaning steps as (pattern, replacement, regex) in the order of the former
+# cleanTxt. The order matters, a removal can create or break matches of
+# later steps. Merging steps into alternations was measured slower with the
+# re module. Literal steps run as str.replace, 'U+' of the former U code
+# pattern is reduced to 'U', runs of U are part of the word class anyway
+clean_steps = [(f'@[{word_chars}]+', '', True),           # @mentions
+               ('#', '', False),                          # '#' of hash tags
+               (f'RT[{whitespace}]+', '', True),          # RT
+               (f'https?://[^{whitespace}]+', '', True),  # hyperlinks
+               (': ', '', False),
+               (f'_[{word_chars}]+', '', True),
+               ('  +', ' ', True),                        # collapse spaces
+               (f'U[{word_chars}]+', '', True),           # U codes
+               (f'[{emoji_chars}]+', '', True),           # emoji
+               ('[\n\t"„“]', ' ', True)]                  # line breaks, tabs, quotes
 
-    # Create a function to get the subjectivity
-    def getSubjectivity(text):
-        return TextBlob(text).sentiment.subjectivity
+def _clean_function(pattern, replacement, regex):
+    # cleaning step for a single text with the pattern compiled once
+    if regex:
+        return partial(re.compile(pattern).sub, replacement)
+    return lambda text: text.replace(pattern, replacement)
 
-    # Create a function to get the polarity
-    def getPolarity(text):
-       return  TextBlob(text).sentiment.polarity
+clean_functions = [_clean_function(*step) for step in clean_steps]
 
-    # Create two new columns 'subjectivity' & 'polarity'
-    df['subjectivity'] = df['text'].apply(getSubjectivity)
-    df['polarity'] = df['text'].apply(getPolarity)
+def clean_text(text):
+    # remove mentions, hash tags, RT, hyperlinks and emoji of a single tweet
+    for function in clean_functions:
+        text = function(text)
+    return text.strip()
+
+def clean_texts(texts):
+    '''Vectorized clean_text over a column of tweets, same results. Every
+    step runs as one pandas str operation over the whole column.
+
+    Parameters
+    ----------
+    texts : pandas Series
+        Tweet texts.
+
+    Returns
+    -------
+    pandas Series
+        Cleaned tweet texts.
+
+    '''
+    for pattern, replacement, regex in clean_steps:
+        texts = texts.str.replace(pattern, replacement, regex=regex)
+    return texts.str.strip()
+
+def sentiment_analysis(df, pool=None, cache=None, scorer=textblob_scores):
+    
+    # Clean the tweets
+    df['text'] = clean_texts(df['text'])
+
+    # score every text once, polarity and subjectivity in one pass. A
+    # process pool of sentiment.scoring_pool scores chunks of the texts in
+    # parallel, None scores in this process. Copies of a text, e.g.
+    # retweets, are scored once. With a score cache of the scorer, see
+    # score_cache.ScoreCache, only tweets without cached scores for their id
+    # and cleaned text are scored.
+    # scorer is textblob_scores or another module level scorer, e.g.
+    # lexicon_scorer.sentiws_scores for german tweets. New scores are checked
+    # with check_scores before they are cached or assigned
+    texts = df['text'].tolist()
+    
+    def score(texts):
+        return check_scores(parallel_scores(texts, scorer, pool), len(texts))
+    
+    if cache is not None:
+        scores = cache.scores(df['id_str'], texts, score)
+    else:
+        scores, _ = distinct_scores(texts, score)
+    df['subjectivity'] = scores[:, score_columns.index('subjectivity')]
+    df['polarity'] = scores[:, score_columns.index('polarity')]
     
     # return the new dataframe with columns 'Subjectivity' & 'Polarity'
     
     return df
 
+def process_tweet_chunks(chunks, pool=None, scorer=textblob_scores):
+    # geocode, assign states and score every chunk of a tweet stream, e.g.
+    # from iter_tweets_from_db, so the raw tweets are never held in memory at
+    # once. Only chunks with matched locations are yielded. pool is the
+    # scoring pool shared by all chunks and scorer the sentiment scorer, see
+    # sentiment_analysis. Scores of earlier runs are taken from the
+    # persistent score cache of the scorer
+    for df in chunks:
+        df = add_coordinates_to_location(df)
+        if len(df):
+            yield sentiment_analysis(add_states(df), pool,
+                                     cache=get_score_cache(scorer), scorer=scorer)
+
 def filter_day_range(df):
-    # format timestamps to datetime objects and assign to new column 
-    # date_created as dates only
+    # format timestamps to datetime objects, a no-op for compacted frames, 
+    # and assign to new column date_created as dates only
     df['created'] = pd.to_datetime(df['created'])
     df['date_created'] = df['created'].dt.date
     
@@ -146,7 +160,6 @@ def filter_day_range(df):
     selection_dates.insert(len(selection_dates), 'Full dataset')
     
     # format time stamps for visualization
-    df['created'] = pd.to_datetime(df['created'])
     df['created'] = df['created'].dt.strftime("%Y-%m-%d %H:%M:%S")
     
     return df, selection_day_range, selection_dates
@@ -22,6 +22,8 @@ from bokeh.util.browser import view
 from bokeh.io import export_png
 
 from html_template import create_html_template
+from state_join import state_aggregates
+from state_join import state_day_aggregates
 
 from utils import resources_dir
 from utils import docs_dir
@@ -226,6 +228,29 @@ def create_geo_data_source(df, selection_day_range):
                                             })
     
     return g_source_dummy, g_source_full, g_sources
+
+def create_state_data_source(df, selection_day_range, state_names):
+    # create one ColumnDataSource of state aggregates for each selected day
+    # and one for the full dataset. The columns are aligned to state_names,
+    # the order of the state patches, so the JS callback can copy them into
+    # the patch source. States without tweets on a day get zeros
+    state_columns = ['tweet_count', 'polarity_mean', 'subjectivity_mean', 'positive_share']
+    
+    def state_source(aggregates):
+        aggregates = aggregates.set_index('state').reindex(state_names)[state_columns]
+        aggregates = aggregates.fillna(0)
+        return ColumnDataSource(data={column: aggregates[column].to_numpy()
+                                      for column in state_columns})
+    
+    # aggregate all days at once and look up the dates of the selected days
+    day_aggregates = state_day_aggregates(df)
+    day_dates = df.groupby('day_range')['date_created'].first()
+    
+    st_sources = [state_source(day_aggregates[day_aggregates['date_created'] == day_dates[day]])
+                  for day in selection_day_range]
+    st_source_full = state_source(state_aggregates(df))
+    
+    return st_sources, st_source_full
     
 def create_bokeh_plot(df,
                       s_source_dummy,
@@ -314,6 +339,15 @@ def create_bokeh_plot(df,
     # load shapefile of germany 
     sf = gpd.read_file(os.path.join(resources_dir, 'shapefiles_ger', 'DEU_adm1.shp'))
     
+    # state aggregates of each selected day and the full dataset. The state
+    # patches start with the first day like the other plots, the JS callback
+    # below switches them with the dropdown
+    st_sources, st_source_full = create_state_data_source(df,
+                                                          selection_day_range,
+                                                          sf['NAME_1'].to_list())
+    for column, values in st_sources[0].data.items():
+        sf[column] = values
+    
     # Input GeoJSON source that contains features for plotting. This format 
     # is required for plotting shapefiles in bokeh plots
     geosource = GeoJSONDataSource(geojson = sf.to_json())
@@ -343,13 +377,32 @@ def create_bokeh_plot(df,
     g_p.axis.major_label_text_color = None
     g_p.axis.axis_line_color = None
     
+    # color the states by their mean polarity, symmetric around 0 to keep
+    # the colors of the sentiment scatter plot and with the same range
+    # over all days to compare the days
+    max_state_polarity = max(max(abs(source.data['polarity_mean']).max()
+                                 for source in st_sources + [st_source_full]),
+                             0.01)
+    state_mapper = LinearColorMapper(palette=PiYG_reverse,
+                                     low=-max_state_polarity,
+                                     high=max_state_polarity)
+    
     # create patches of the german states using the geosources
-    g_p.patches('xs','ys', 
-                source = geosource,
-                fill_color = '#ffbaba',
-                line_color = '#f5f5f5',
-                line_width = 1, 
-                fill_alpha = 1)
+    state_patches = g_p.patches('xs','ys', 
+                                source = geosource,
+                                fill_color = transform('polarity_mean', state_mapper),
+                                line_color = '#f5f5f5',
+                                line_width = 1, 
+                                fill_alpha = 0.6)
+    
+    # create hover tool for the state aggregates
+    g_p.add_tools(HoverTool(renderers = [state_patches],
+                      tooltips = [("State","@NAME_1"),
+                                  ("Tweets","@tweet_count"),
+                                  ("Mean polarity","@polarity_mean{0.000}"),
+                                  ("Mean subjectivity","@subjectivity_mean{0.000}"),
+                                  ("Positive tweets","@positive_share{0.0%}")
+                                  ]))
     
     # geo source scatter plot of city counts
     scatter = g_p.scatter('g_x',
@@ -390,7 +443,15 @@ def create_bokeh_plot(df,
       'source13': g_source4,
       'source14': g_source5,
       'source15': g_source6,
-      'source16': g_source_full}, code="""
+      'source16': g_source_full,
+      'source17': geosource,
+      'source18': st_sources[0],
+      'source19': st_sources[1],
+      'source20': st_sources[2],
+      'source21': st_sources[3],
+      'source22': st_sources[4],
+      'source23': st_sources[5],
+      'source24': st_source_full}, code="""
       
         var data1 = source1.data;
         var data2 = source2.data;
@@ -408,6 +469,14 @@ def create_bokeh_plot(df,
         var data14 = source14.data;
         var data15 = source15.data;
         var data16 = source16.data;
+        var data17 = source17.data;
+        var data18 = source18.data;
+        var data19 = source19.data;
+        var data20 = source20.data;
+        var data21 = source21.data;
+        var data22 = source22.data;
+        var data23 = source23.data;
+        var data24 = source24.data;
         
         var f = cb_obj.value;
       
@@ -427,6 +496,9 @@ def create_bokeh_plot(df,
           data9['name'] = data10['name'];
           data9['count'] = data10['count'];
           data9['bins'] = data10['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data18) data17[k] = data18[k];
         }
       
         if (f == %s) {
@@ -445,6 +517,9 @@ def create_bokeh_plot(df,
           data9['name'] = data11['name'];
           data9['count'] = data11['count'];
           data9['bins'] = data11['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data19) data17[k] = data19[k];
         }
       
         if (f == %s) {
@@ -463,6 +538,9 @@ def create_bokeh_plot(df,
           data9['name'] = data12['name'];
           data9['count'] = data12['count'];
           data9['bins'] = data12['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data20) data17[k] = data20[k];
         }
         
         if (f == %s) {
@@ -481,6 +559,9 @@ def create_bokeh_plot(df,
           data9['name'] = data13['name'];
           data9['count'] = data13['count'];
           data9['bins'] = data13['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data21) data17[k] = data21[k];
         }
         
         if (f == %s) {
@@ -499,6 +580,9 @@ def create_bokeh_plot(df,
           data9['name'] = data14['name'];
           data9['count'] = data14['count'];
           data9['bins'] = data14['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data22) data17[k] = data22[k];
         }
         
         if (f == %s) {
@@ -517,6 +601,9 @@ def create_bokeh_plot(df,
           data9['name'] = data15['name'];
           data9['count'] = data15['count'];
           data9['bins'] = data15['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data23) data17[k] = data23[k];
         }
         
         if (f == %s) {
@@ -535,10 +622,14 @@ def create_bokeh_plot(df,
           data9['name'] = data16['name'];
           data9['count'] = data16['count'];
           data9['bins'] = data16['bins'];
+          
+          // the state patches keep their shapes, only the aggregates change
+          for (var k in data24) data17[k] = data24[k];
         }
             
         source1.change.emit();
         source9.change.emit();
+        source17.change.emit();
     """ % (selection_dates_js[0], 
             selection_dates_js[1], 
             selection_dates_js[2],
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Shared connection layer for geo_tweets_germany.db. The scraper writes through
+dataset connections, the loader reads through pooled read-only sqlite3
+connections. The database runs in WAL mode so readers see a consistent
+snapshot while the scraper is writing and neither side blocks the other.
+"""
+import threading
+from contextlib import contextmanager
+
+import sqlite3
+import dataset
+
+from utils import db_path
+
+# seconds a connection waits for a lock before raising 'database is locked'
+busy_timeout = 30
+
+_pool = {}
+_pool_lock = threading.Lock()
+_migrated = set()
+
+def enable_wal(path=db_path):
+    # WAL mode is persistent, it is stored in the database file itself
+    conn = sqlite3.connect(path, timeout=busy_timeout)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+def connect_writer(path=db_path):
+    '''Open a dataset connection for writing tweets.
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file. The default is utils.db_path.
+
+    Returns
+    -------
+    dataset.Database
+
+    '''
+    enable_wal(path)
+    return dataset.connect(f'sqlite:///{path}',
+                           engine_kwargs={'connect_args': {'timeout': busy_timeout}})
+
+@contextmanager
+def write_connection(path=db_path):
+    # short lived sqlite3 connection for schema migrations
+    enable_wal(path)
+    conn = sqlite3.connect(path, timeout=busy_timeout)
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def ensure_date_index(conn, table_name='tweets'):
+    '''Add the generated created_date column and the indexes on created and
+    created_date if they do not exist yet.
+
+    created_date holds date(created) as '%Y-%m-%d' string. Filtering on it
+    instead of calling date() on created lets sqlite search the index rather
+    than scanning the whole table.
+    '''
+    # table_xinfo also lists generated columns, table_info does not
+    columns = [info[1] for info in conn.execute(f'PRAGMA table_xinfo({table_name})')]
+    if 'created_date' not in columns:
+        conn.execute(f'''ALTER TABLE {table_name} ADD COLUMN created_date TEXT
+                         GENERATED ALWAYS AS (date(created)) VIRTUAL''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table_name}_created ON {table_name} (created)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS ix_{table_name}_created_date ON {table_name} (created_date)')
+    conn.commit()
+
+def migrate(path=db_path):
+    # apply the loader schema migrations once per process and database
+    if path in _migrated:
+        return
+    with write_connection(path) as conn:
+        ensure_date_index(conn)
+    _migrated.add(path)
+
+def _open_reader(path):
+    # read-only connection in autocommit mode, transactions are started
+    # explicitly to pin a snapshot
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                           timeout=busy_timeout, isolation_level=None,
+                           check_same_thread=False)
+    conn.execute('PRAGMA query_only=ON')
+    return conn
+
+@contextmanager
+def reader(path=db_path):
+    '''Borrow a pooled read-only connection for a consistent snapshot.
+
+    All queries inside the with block read the same state of the database,
+    rows committed by the scraper in the meantime only become visible to
+    later readers. The connection is returned to the pool afterwards.
+
+    Parameters
+    ----------
+    path : str, optional
+        Database file. The default is utils.db_path.
+
+    Yields
+    ------
+    sqlite3.Connection
+
+    '''
+    migrate(path)
+    with _pool_lock:
+        idle = _pool.setdefault(path, [])
+        conn = idle.pop() if idle else None
+    if conn is None:
+        conn = _open_reader(path)
+
+    # connections of failed or abandoned reads are closed, not reused
+    finished = False
+    try:
+        conn.execute('BEGIN')
+        yield conn
+        conn.execute('COMMIT')
+        finished = True
+    finally:
+        if finished:
+            with _pool_lock:
+                _pool[path].append(conn)
+        else:
+            conn.close()
+
+def close_readers():
+    # close all idle pooled connections
+    with _pool_lock:
+        for idle in _pool.values():
+            for conn in idle:
+                conn.close()
+        _pool.clear()
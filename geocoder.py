@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Geocoder for german city names. The city table of geodata_german_cities.csv
+is built once per process and cached as compact numpy archive, locations are
+resolved in one vectorized pass over their distinct values.
+
+Locations and city names are compared in a folded form: uppercase, umlauts
+transliterated (Ü -> UE, ß -> SS), accents, emoji and punctuation removed.
+City names with umlauts or SS also match their plain spellings, e.g.
+'MUNCHEN' or 'GROSENHAIN'. Locations without an exact match are matched by
+their leading words, city name prefixes and finally by a doubled or missing
+letter of the whole first segment. Geotagged tweets are snapped to the
+nearest city instead.
+"""
+import os
+import hashlib
+from collections import defaultdict
+from functools import cached_property
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from utils import cache_dir
+from utils import resources_dir
+
+cities_csv = os.path.join(resources_dir, 'geodata_german_cities.csv')
+geocoder_cache = os.path.join(cache_dir, 'geocoder.npz')
+
+umlaut_table = str.maketrans({'ä': 'ae', 'ö': 'oe', 'ü': 'ue',
+                              'Ä': 'AE', 'Ö': 'OE', 'Ü': 'UE',
+                              'ß': 'ss', 'ẞ': 'SS'})
+
+# longest word sequence of a location compared with city names
+max_phrase_words = 4
+
+# shortest word sequence matched by prefix, shorter ones like 'AM' or 'BAD'
+# match too many cities
+min_prefix_length = 5
+
+# shortest first segment and city name matched by a typo. Shorter words
+# are too often one letter away from a city
+min_fuzzy_length = 7
+
+# plain spellings of umlauts and SS in the city names, both are also written
+# without the extra letter, e.g. 'MUNCHEN', 'GROSENHAIN'
+plain_spellings = [('AE', 'A'), ('OE', 'O'), ('UE', 'U'), ('SS', 'S')]
+
+# geotags farther from the nearest city, e.g. in neighbouring countries, fall
+# back to the user location
+snap_distance_km = 20
+earth_radius_km = 6371.0
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def fold(texts):
+    '''Fold a Series of strings for comparison, e.g. 'Düsseldorf 🌍' ->
+    'DUESSELDORF', 'Berlin-Mitte, Germany' -> 'BERLIN MITTE,GERMANY'.
+    Commas are kept as separators of location segments.'''
+    texts = texts.astype(str).str.translate(umlaut_table).str.upper()
+    texts = texts.str.normalize('NFKD').str.replace('[\u0300-\u036f]', '', regex=True)
+    texts = texts.str.replace(r'[^A-Z0-9,]+', ' ', regex=True)
+    return texts.str.replace(r' *, *', ',', regex=True).str.strip()
+
+def doubled_letter_edit(a, b):
+    # True if a and b differ by one letter of a double letter, e.g.
+    # 'HAMBURGG' and 'HAMBURG' or 'STUTGART' and 'STUTTGART'. Other single
+    # edits mostly turn foreign and regional names into german towns, e.g.
+    # 'SCHWEIZ' -> 'SCHLEIZ', 'HOLLAND' -> 'HOLTLAND'. SS is the spelling
+    # of ß, see plain_spellings, so 'STRASSBURG' is no typo of 'STRASBURG'
+    if len(a) < len(b):
+        a, b = b, a
+    if len(a) != len(b) + 1:
+        return False
+    i = next((i for i, (char_a, char_b) in enumerate(zip(a, b)) if char_a != char_b), len(b))
+    return (a[:i] + a[i + 1:] == b and a[i] != 'S'
+            and (a[i - 1:i] == a[i] or a[i + 1:i + 2] == a[i]))
+
+def plain_variants(key):
+    # spellings of a folded name without the transliterated umlauts and SS
+    variants = {key}
+    for spelling, plain in plain_spellings:
+        variants |= {variant.replace(spelling, plain) for variant in variants}
+    return variants - {key}
+
+def unit_vectors(longitude, latitude):
+    # points on the unit sphere, euclidean distances of these are monotonic
+    # in the great circle distance
+    longitude, latitude = np.radians(longitude), np.radians(latitude)
+    return np.column_stack([np.cos(latitude) * np.cos(longitude),
+                            np.cos(latitude) * np.sin(longitude),
+                            np.sin(latitude)])
+
+def deletions(text):
+    # all strings derived from text by deleting one char
+    return {text} | {text[:i] + text[i + 1:] for i in range(len(text))}
+
+
+class Geocoder:
+    '''Lookup of city names to longitude and latitude.
+
+    Note that the longitude column of geodata_german_cities.csv holds the
+    latitudes and vice versa, the names are kept as they are used by the
+    plots.
+
+    Parameters
+    ----------
+    cities : array of str
+        Uppercase city names, unique.
+    longitude, latitude : array of float
+        Coordinates of the cities.
+    fuzzy : bool, optional
+        Match first segments with a doubled or missing letter, see
+        doubled_letter_edit. The default is True.
+
+    '''
+    def __init__(self, cities, longitude, latitude, fuzzy=True):
+        self.cities = pd.Index(cities)
+        self.longitude = np.asarray(longitude)
+        self.latitude = np.asarray(latitude)
+        self.fuzzy = fuzzy
+        
+        # folded name -> city position, the last city wins for names that
+        # fold to the same string
+        folded = fold(pd.Series(self.cities.to_numpy(dtype=str))).str.replace(',', ' ')
+        self.lookup = dict(zip(folded, range(len(folded))))
+        
+        # plain spellings of names with umlauts or SS, unless they are the
+        # name of another city or shared by several cities
+        plain = defaultdict(set)
+        for key, position in self.lookup.items():
+            for variant in plain_variants(key):
+                plain[variant].add(position)
+        for variant, positions in plain.items():
+            if len(positions) == 1 and variant not in self.lookup:
+                self.lookup[variant] = positions.pop()
+        self.keys = pd.Index(list(self.lookup))
+        self.key_positions = np.fromiter(self.lookup.values(), dtype=np.int64)
+        
+        # sorted folded names serve as prefix index: all names starting with
+        # a phrase are one contiguous slice
+        self.sorted_keys = np.array(sorted(self.lookup), dtype=object)
+        
+        # deletion index for the typo fallback: two strings one letter
+        # apart share a string derived by at most one deletion each
+        self.deletion_index = defaultdict(set)
+        if fuzzy:
+            for key in self.lookup:
+                if len(key) >= min_fuzzy_length:
+                    for deleted in deletions(key):
+                        self.deletion_index[deleted].add(key)
+
+    @classmethod
+    def from_csv(cls, path=cities_csv):
+        df_geo = pd.read_csv(path, usecols=['City', 'longitude', 'latitude'])
+        # the last entry of duplicated city names wins, like a dict of the
+        # city list would
+        df_geo = df_geo.drop_duplicates(subset='City', keep='last')
+        return cls(df_geo['City'].to_numpy(dtype=str),
+                   df_geo['longitude'].to_numpy(),
+                   df_geo['latitude'].to_numpy())
+
+    @classmethod
+    def load(cls, path=geocoder_cache, csv_path=cities_csv):
+        '''Load the geocoder from the binary cache, rebuild the cache from
+        the csv file if it is missing or the csv file changed.'''
+        csv_hash = file_hash(csv_path)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                if str(cached['csv_hash']) == csv_hash:
+                    return cls(cached['cities'], cached['longitude'], cached['latitude'])
+
+        geocoder = cls.from_csv(csv_path)
+        geocoder.save(path, csv_hash)
+        return geocoder
+
+    def save(self, path, csv_hash=''):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, np.savez appends .npz to names
+        # without that suffix
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path,
+                 cities=self.cities.to_numpy(dtype=str),
+                 longitude=self.longitude,
+                 latitude=self.latitude,
+                 csv_hash=np.array(csv_hash))
+        os.replace(tmp_path, path)
+
+    @cached_property
+    def tree(self):
+        # KD-tree of the city positions, built on first use. The csv columns
+        # are swapped, latitude holds the longitudes
+        return cKDTree(unit_vectors(self.latitude, self.longitude))
+
+    def nearest(self, longitude, latitude, max_km=snap_distance_km):
+        '''Snap points to the nearest city.
+
+        Parameters
+        ----------
+        longitude, latitude : array of float
+            Points in degrees, NaN for missing points.
+        max_km : float, optional
+            Maximum distance to the city. The default is snap_distance_km.
+
+        Returns
+        -------
+        positions : numpy array of int
+            Row of the nearest city in the city table, -1 for missing points
+            and points without city within max_km.
+
+        '''
+        longitude = np.asarray(longitude, dtype=np.float64)
+        latitude = np.asarray(latitude, dtype=np.float64)
+        positions = np.full(len(longitude), -1, dtype=np.int64)
+        valid = np.flatnonzero(~(np.isnan(longitude) | np.isnan(latitude)))
+        if len(valid):
+            # chord length of max_km on the unit sphere
+            max_chord = 2 * np.sin(max_km / earth_radius_km / 2)
+            distance, nearest = self.tree.query(unit_vectors(longitude[valid], latitude[valid]),
+                                                distance_upper_bound=max_chord)
+            positions[valid] = np.where(np.isfinite(distance), nearest, -1)
+        return positions
+
+    def _prefix_match(self, phrase):
+        # shortest city name that starts with the phrase as whole words,
+        # e.g. 'FRANKFURT' -> 'FRANKFURT AM MAIN'
+        start = np.searchsorted(self.sorted_keys, phrase + ' ')
+        end = np.searchsorted(self.sorted_keys, phrase + ' \uffff')
+        if start == end:
+            return None
+        return min(self.sorted_keys[start:end], key=len)
+
+    def _fuzzy_match(self, phrase):
+        # the only city name one doubled letter away, None if there is none
+        # or several
+        candidates = set()
+        for deleted in deletions(phrase):
+            candidates |= self.deletion_index.get(deleted, set())
+        matches = {self.lookup[key] for key in candidates if doubled_letter_edit(phrase, key)}
+        return matches.pop() if len(matches) == 1 else None
+
+    def match_location(self, folded):
+        '''Match a single folded location without an exact match of its
+        first segment.
+
+        The leading words of every comma separated segment are tried from
+        the longest to the shortest word sequence as exact city names and as
+        city name prefixes, then the whole first segment with a doubled or
+        missing letter, e.g. 'BERLIN MITTE' -> 'BERLIN', 'BAD HOMBURG' ->
+        'BAD HOMBURG VOR DER HOEHE', 'HAMBURGG' -> 'HAMBURG'. Words in the
+        middle of a segment are not matched, e.g. 'IRGENDWO IM NORDEN' or
+        'LANDKREIS HARBURG' stay unmatched.
+
+        Returns
+        -------
+        int
+            Position of the matched city, -1 if not found.
+
+        '''
+        segments = folded.split(',')
+        for segment in segments:
+            words = segment.split()
+            for n in range(min(len(words), max_phrase_words), 0, -1):
+                phrase = ' '.join(words[:n])
+                if phrase in self.lookup:
+                    return self.lookup[phrase]
+                if len(phrase) < min_prefix_length:
+                    continue
+                key = self._prefix_match(phrase)
+                if key is not None:
+                    return self.lookup[key]
+        if self.fuzzy and len(segments[0]) >= min_fuzzy_length:
+            position = self._fuzzy_match(segments[0])
+            if position is not None:
+                return position
+        return -1
+
+    def match_distinct(self, locations):
+        '''Match distinct locations in one batch: the first comma separated
+        segment is matched against all city names at once, the remaining
+        locations go through match_location.
+
+        Parameters
+        ----------
+        locations : array of str
+            Distinct locations.
+
+        Returns
+        -------
+        positions : numpy array of int
+            Row of the matched city in the city table, -1 if not found.
+
+        '''
+        folded = fold(pd.Series(locations, dtype=object))
+        first_segments = folded.str.split(',', n=1).str[0]
+        
+        indexer = self.keys.get_indexer(first_segments)
+        positions = np.where(indexer >= 0, self.key_positions[indexer], -1)
+        for i in np.flatnonzero(positions < 0):
+            if folded.iat[i]:
+                positions[i] = self.match_location(folded.iat[i])
+        return positions
+
+    def resolve(self, locations, cache=None):
+        '''Resolve a column of free text locations.
+
+        Only the distinct values are looked up, the results are scattered
+        back to the rows with their codes.
+
+        Parameters
+        ----------
+        locations : pandas Series
+            user_location column.
+        cache : location_cache.LocationCache, optional
+            Persistent cache of resolved locations, only locations missing
+            in the cache are matched. The default is None.
+
+        Returns
+        -------
+        cleaned : numpy array of object
+            Matched city names, None for rows without a match.
+        positions : numpy array of int
+            Row of the matched city in the city table, -1 if not found.
+
+        '''
+        codes, uniques = pd.factorize(locations)
+        if cache is not None:
+            unique_positions = cache.resolve(uniques, self)
+        else:
+            unique_positions = self.match_distinct(uniques)
+        
+        # factorize codes missing values as -1
+        positions = np.where(codes >= 0, np.append(unique_positions, -1)[codes], -1)
+        names = np.append(self.cities.to_numpy(dtype=object), None)
+        return names[positions], positions
+
+    def add_coordinates(self, df, column='user_location', cache=None):
+        '''Keep the rows of df with a known city and add the
+        user_location_cleaned, longitude and latitude columns.
+
+        Tweets with geotag in the tweet_longitude and tweet_latitude columns
+        are snapped to the nearest city, all other tweets are resolved by
+        their user location.
+        '''
+        positions = np.full(len(df), -1, dtype=np.int64)
+        if 'tweet_longitude' in df.columns:
+            positions = self.nearest(df['tweet_longitude'], df['tweet_latitude'])
+        unsnapped = np.flatnonzero(positions < 0)
+        positions[unsnapped] = self.resolve(df[column].iloc[unsnapped], cache)[1]
+
+        matched = np.flatnonzero(positions >= 0)
+        positions = positions[matched]
+
+        df = df.take(matched)
+        df['user_location_cleaned'] = self.cities.to_numpy(dtype=object)[positions]
+        df['longitude'] = self.longitude[positions]
+        df['latitude'] = self.latitude[positions]
+        return df
+
+@lru_cache(maxsize=None)
+def get_geocoder():
+    # one geocoder per process
+    return Geocoder.load()
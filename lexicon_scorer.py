@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized lexicon sentiment scoring of german tweets with the SentiWS
+lexicon of the University of Leipzig.
+
+A batch of texts is tokenized at once by pyarrow compute functions into a
+sparse document-term matrix of the lexicon words, the scores of all texts
+are the product of that matrix with the lexicon weights. The lexicon is not
+part of the repository, download SentiWS and extract
+SentiWS_v2.0_Positive.txt and SentiWS_v2.0_Negative.txt to
+resources/SentiWS.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from scipy import sparse
+
+from utils import resources_dir
+
+sentiws_dir = os.path.join(resources_dir, 'SentiWS')
+sentiws_files = [os.path.join(sentiws_dir, 'SentiWS_v2.0_Positive.txt'),
+                 os.path.join(sentiws_dir, 'SentiWS_v2.0_Negative.txt')]
+
+# files the scores depend on, hashed into the scorer version of the score
+# cache
+scorer_resources = sentiws_files
+
+# separators of words, i.e. words are runs of unicode letters. RE2 syntax of
+# the arrow regex functions
+separator_pattern = r'[^\pL]+'
+
+def read_sentiws(paths=sentiws_files):
+    '''Read the word weights of SentiWS files.
+
+    Every line holds a base form with its part of speech, its weight and
+    optionally a comma separated list of inflected forms, e.g.
+    'Abbau|NN<tab>-0.058<tab>Abbaus,Abbaues,Abbauen,Abbaue'. The inflected
+    forms get the weight of their base form.
+
+    Parameters
+    ----------
+    paths : list of str, optional
+        SentiWS files. The default is the positive and negative file in
+        resources/SentiWS.
+
+    Returns
+    -------
+    weights : pandas Series object.
+        Weights in [-1, 1] by lower case word. Words of more than one base
+        form get the mean of their weights.
+
+    '''
+    words, weights = [], []
+    for path in paths:
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 2:
+                    continue
+                forms = [fields[0].split('|')[0]]
+                if len(fields) > 2 and fields[2]:
+                    forms += fields[2].split(',')
+                words += forms
+                weights += [float(fields[1])] * len(forms)
+    weights = pd.Series(weights, index=pd.Index(words, dtype=object).str.lower())
+    return weights.groupby(level=0).mean()
+
+
+class LexiconScorer:
+    '''Bag of words scorer of a polarity lexicon.
+
+    The polarity of a text is the mean weight of its lexicon words, the
+    subjectivity is the share of its words found in the lexicon. Texts
+    without lexicon words score 0 for both, like in TextBlob. Negations and
+    intensifiers are not handled.
+
+    Parameters
+    ----------
+    words : array of str
+        Lower case lexicon words.
+    polarity : array of float
+        Weights of the words in [-1, 1].
+
+    '''
+    def __init__(self, words, polarity):
+        self.vocabulary = pa.array(np.asarray(words, dtype=str), pa.large_string())
+        # one column of weight sums and one of lexicon word counts, both are
+        # computed in a single matrix product
+        self.weights = np.column_stack([np.asarray(polarity, dtype=np.float64),
+                                        np.ones(len(self.vocabulary))])
+
+    @classmethod
+    def from_sentiws(cls, paths=sentiws_files):
+        weights = read_sentiws(paths)
+        return cls(weights.index, weights.to_numpy())
+
+    def document_terms(self, texts):
+        '''Sparse document-term matrix of the lexicon words in texts.
+
+        Returns
+        -------
+        counts : scipy sparse csr_matrix, shape (n, number of words)
+            Number of occurrences of every lexicon word per text.
+        n_tokens : numpy array of int
+            Number of words per text.
+
+        '''
+        # words of all texts as one flat array, the list lengths give the
+        # text of every word. Splitting leaves empty strings at separators
+        # at the start or end of a text
+        texts = pa.array(list(texts), pa.large_string())
+        tokens = pc.split_pattern_regex(pc.utf8_lower(texts), separator_pattern)
+        docs = np.repeat(np.arange(len(texts)),
+                         pc.list_value_length(tokens).to_numpy(zero_copy_only=False))
+        words = tokens.flatten()
+        nonempty = pc.greater(pc.binary_length(words), 0).to_numpy(zero_copy_only=False)
+        n_tokens = np.bincount(docs[nonempty], minlength=len(texts))
+
+        # hash lookup of the lexicon words, -1 for other words
+        terms = pc.fill_null(pc.index_in(words, value_set=self.vocabulary), -1)
+        terms = terms.to_numpy(zero_copy_only=False)
+        known = terms >= 0
+        counts = sparse.csr_matrix((np.ones(int(known.sum())), (docs[known], terms[known])),
+                                   shape=(len(texts), len(self.vocabulary)))
+        return counts, n_tokens
+
+    def scores(self, texts):
+        '''Polarity and subjectivity of every text.
+
+        Parameters
+        ----------
+        texts : sequence of str
+            Cleaned tweet texts.
+
+        Returns
+        -------
+        scores : numpy array of float64, shape (n, 2)
+            Columns polarity and subjectivity.
+
+        '''
+        counts, n_tokens = self.document_terms(texts)
+        sums = counts @ self.weights
+        weight_sums, matched = sums[:, 0], sums[:, 1]
+
+        scores = np.zeros((len(n_tokens), 2), dtype=np.float64)
+        found = matched > 0
+        scores[found, 0] = weight_sums[found] / matched[found]
+        scores[found, 1] = matched[found] / n_tokens[found]
+        return scores
+
+@lru_cache(maxsize=None)
+def get_sentiws_scorer():
+    # the lexicon is read once per process
+    return LexiconScorer.from_sentiws()
+
+def sentiws_scores(texts):
+    '''Polarity and subjectivity of the SentiWS lexicon, see LexiconScorer.
+
+    Parameters
+    ----------
+    texts : sequence of str
+        Cleaned tweet texts.
+
+    Returns
+    -------
+    scores : numpy array of float64, shape (n, 2)
+        Columns polarity and subjectivity.
+
+    '''
+    return get_sentiws_scorer().scores(texts)
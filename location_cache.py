@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of resolved user locations. Maps every raw user_location
+string seen so far to its matched city, or to no city, in a small sqlite
+database in the cache folder, so incremental builds only geocode locations
+that never came up before.
+
+Run this module to print the size of the cache.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import inspect
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import geocoder
+
+from database import busy_timeout
+from utils import cache_dir
+
+location_cache_db = os.path.join(cache_dir, 'locations.db')
+
+# bump to invalidate the cache. Changes of the city table or of the geocoder
+# code invalidate it automatically. 2: drops the fuzzy matches of foreign and
+# regional names of earlier geocoders
+location_cache_version = '2'
+
+def cache_version():
+    # cached results are only valid for the same city table and matcher
+    sha = hashlib.sha1(location_cache_version.encode())
+    sha.update(geocoder.file_hash(geocoder.cities_csv).encode())
+    sha.update(inspect.getsource(geocoder).encode())
+    return sha.hexdigest()
+
+
+class LocationCache:
+    '''Persistent mapping of raw locations to city names.
+
+    Locations without a matching city are cached as well, with city NULL.
+    The cached entries are read once per instance and kept in memory, new
+    results are written through to the database.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache database file. The default is cache/locations.db.
+    version : str, optional
+        Version of the cached results, the cache is cleared if it was written
+        by another version. The default is cache_version().
+
+    '''
+    def __init__(self, path=location_cache_db, version=None):
+        self.path = path
+        self.version = version or cache_version()
+        self.hits = 0
+        self.misses = 0
+        self.match_time = 0.0
+        self.cached = None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                conn.execute('CREATE TABLE IF NOT EXISTS locations (location TEXT PRIMARY KEY, city TEXT)')
+                row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+                if row is None or row[0] != self.version:
+                    conn.execute('DELETE FROM locations')
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=busy_timeout)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _load(self):
+        # location -> city name, None for negative results
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT location, city FROM locations').fetchall()
+        finally:
+            conn.close()
+        locations = [location for location, _ in rows]
+        self.cached = pd.Series([city for _, city in rows], index=pd.Index(locations, dtype=object),
+                                dtype=object)
+
+    def resolve(self, locations, matcher):
+        '''Resolve distinct locations, matching only those missing in the
+        cache.
+
+        Parameters
+        ----------
+        locations : array of str
+            Distinct locations.
+        matcher : geocoder.Geocoder
+            Geocoder for the cache misses.
+
+        Returns
+        -------
+        positions : numpy array of int
+            Row of the matched city in the city table of matcher, -1 if not
+            found.
+
+        '''
+        if self.cached is None:
+            self._load()
+        locations = pd.Index(locations, dtype=object)
+        indexer = self.cached.index.get_indexer(locations)
+        hit = indexer >= 0
+
+        # cached city names to positions in the current city table
+        positions = np.full(len(locations), -1, dtype=np.int64)
+        cities = self.cached.to_numpy()[indexer[hit]]
+        positions[hit] = matcher.cities.get_indexer(cities)
+
+        missing = locations[~hit]
+        if len(missing):
+            t0 = time.perf_counter()
+            matched = matcher.match_distinct(missing.to_numpy())
+            self.match_time += time.perf_counter() - t0
+            positions[~hit] = matched
+            names = np.append(matcher.cities.to_numpy(dtype=object), None)[matched]
+            self._store(missing, names)
+
+        self.hits += int(hit.sum())
+        self.misses += len(missing)
+        return positions
+
+    def _store(self, locations, cities):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO locations VALUES (?, ?)',
+                                 zip(locations, cities))
+        finally:
+            conn.close()
+        new = pd.Series(cities, index=locations, dtype=object)
+        self.cached = pd.concat([self.cached, new])
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return (f'location cache: {self.hits} hits, {self.misses} misses '
+                f'({self.hit_rate():.1%} hit rate), {self.match_time:.2f} s geocoding misses')
+
+    def __len__(self):
+        if self.cached is None:
+            self._load()
+        return len(self.cached)
+
+@lru_cache(maxsize=None)
+def get_location_cache():
+    # one cache per process
+    return LocationCache()
+
+if __name__ == '__main__':
+    cache = get_location_cache()
+    n_cached = len(cache)
+    print(f'{n_cached} cached locations, {int(cache.cached.isna().sum())} without city')
@@ -1,19 +1,29 @@
-from data_loader import load_tweets_from_db
+import os
+
+from snapshot_cache import load_enriched_tweets
+
+from sentiment import get_scorer
 
-from data_processing import add_coordinates_to_location
-from data_processing import sentiment_analysis
 from data_processing import filter_day_range
 
 from data_visualization import create_sentiment_data_source
 from data_visualization import create_geo_data_source
 from data_visualization import create_bokeh_plot
 
+# columns of the processed tweets used by the dashboard, the other snapshot
+# columns are not read
+dashboard_columns = ['created', 'user_name', 'text', 'user_location_cleaned',
+                     'longitude', 'latitude', 'state', 'polarity', 'subjectivity']
+
 if __name__ == '__main__':
-    df = load_tweets_from_db()
-    
-    df = add_coordinates_to_location(df)
-    
-    df = sentiment_analysis(df)
+    # geocoded and scored tweets from the snapshot cache, only tweets new
+    # since the last build are processed, scored on all CPUs by the scorer
+    # named in GEOSENTIMENT_SCORER, textblob by default. Set
+    # GEOSENTIMENT_STORAGE=partitions for tweets collected with
+    # partitioned=True
+    df = load_enriched_tweets(processes=None, scorer=get_scorer(),
+                              output_columns=dashboard_columns,
+                              partitioned=os.environ.get('GEOSENTIMENT_STORAGE') == 'partitions')
 
     df, selection_day_range, selection_dates = filter_day_range(df)
     
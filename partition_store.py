@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Optional day-partitioned storage of the tweets as Parquet files, one folder
+per day: partitions/created_date=YYYY-MM-DD/part-*.parquet. Writers add
+small part files, loaders only read the folders of the requested days and
+old days are compacted to a single compressed file. The part file names
+start with their write time, which serves as position of incremental
+builds like the rowid of the tweets table.
+
+Run this module to compact all partitions older than 7 days.
+"""
+import os
+import time
+import uuid
+import hashlib
+from datetime import date
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from data_loader import compact_dtypes
+from data_loader import date_intervals
+from data_loader import parse_coordinates
+from data_loader import parse_date
+from data_loader import resolve_date_arguments
+from data_loader import tweet_columns
+
+from utils import partitions_dir
+
+partition_prefix = 'created_date='
+compacted_prefix = 'compacted-'
+
+tweet_schema = pa.schema([('created', pa.timestamp('us')),
+                          ('user_name', pa.string()),
+                          ('user_location', pa.string()),
+                          ('coordinates', pa.string()),
+                          ('user_description', pa.string()),
+                          ('text', pa.string()),
+                          ('id_str', pa.string()),
+                          ('retweet_count', pa.int64()),
+                          ('user_followers', pa.int64()),
+                          ('user_created', pa.timestamp('us'))])
+
+def partition_path(day, root=partitions_dir):
+    return os.path.join(root, f'{partition_prefix}{day}')
+
+def list_partitions(root=partitions_dir):
+    # dates of all existing day partitions
+    if not os.path.isdir(root):
+        return []
+    return sorted(date.fromisoformat(name[len(partition_prefix):])
+                  for name in os.listdir(root)
+                  if name.startswith(partition_prefix))
+
+def part_time(path):
+    # write time in ns of a part file, e.g. part-<ns>-<id>.parquet
+    return int(os.path.basename(path).split('-')[1])
+
+def part_files(day, root=partitions_dir, min_part_time=None, max_part_time=None):
+    # part files of a day in write order, the file names start with the
+    # write time in ns. Optionally only files written after min_part_time
+    # up to max_part_time
+    path = partition_path(day, root)
+    files = [os.path.join(path, name) for name in sorted(os.listdir(path))
+             if name.endswith('.parquet')]
+    return [file for file in files
+            if (min_part_time is None or part_time(file) > min_part_time)
+            and (max_part_time is None or part_time(file) <= max_part_time)]
+
+def partitions_state(root=partitions_dir, max_part_time=None):
+    '''Write time of the newest part file and a hash of the names of all
+    part files, optionally only of those written up to max_part_time.
+
+    The hash changes if part files were removed, e.g. by
+    compact_partitions, so tweets read before may have been rewritten.
+    '''
+    files = [file for day in list_partitions(root)
+             for file in part_files(day, root, max_part_time=max_part_time)]
+    sha = hashlib.sha1('\n'.join(os.path.basename(file) for file in files).encode())
+    return max((part_time(file) for file in files), default=0), sha.hexdigest()
+
+def write_part(table, day, root=partitions_dir, compacted=False):
+    # write a part file atomically: readers never see half written files
+    path = partition_path(day, root)
+    os.makedirs(path, exist_ok=True)
+    prefix = compacted_prefix if compacted else 'part-'
+    name = f'{prefix}{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet'
+    tmp_path = os.path.join(path, '.' + name + '.tmp')
+    pq.write_table(table, tmp_path,
+                   compression='zstd' if compacted else 'snappy')
+    os.replace(tmp_path, os.path.join(path, name))
+    return os.path.join(path, name)
+
+
+class PartitionWriter:
+    '''Buffered writer for day-partitioned Parquet storage.
+
+    Same interface as tweet_store.TweetWriter: rows are collected with add()
+    and every flush() writes one snappy compressed part file per day of the
+    buffered rows.
+
+    Parameters
+    ----------
+    root : str, optional
+        Partitions folder. The default is utils.partitions_dir.
+    batch_size : int, optional
+        Number of buffered rows that trigger an automatic flush. None only
+        flushes on explicit flush() calls. The default is None.
+    checkpoint : tweet_store.Checkpoint, optional
+        Collection checkpoint saved to db after the part files of every batch
+        are written. The default is None.
+    db : dataset.Database, optional
+        Database holding the checkpoints table.
+
+    '''
+    def __init__(self, root=partitions_dir, batch_size=None, checkpoint=None, db=None):
+        self.root = root
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.db = db
+        self.buffer = []
+        self.rows_written = 0
+        self.batches_written = 0
+        self.files_written = 0
+        self.write_time = 0.0
+        self.max_write_latency = 0.0
+        self.start_time = time.perf_counter()
+
+    def add(self, row):
+        self.buffer.append(row)
+        if self.batch_size and len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return 0
+        t0 = time.perf_counter()
+        table = pa.Table.from_pylist(self.buffer, schema=tweet_schema)
+        days = pc.strftime(table['created'], format='%Y-%m-%d')
+        for day in pc.unique(days).to_pylist():
+            write_part(table.filter(pc.equal(days, day)), day, self.root)
+            self.files_written += 1
+
+        # the checkpoint never points past rows that are not written
+        if self.checkpoint is not None:
+            self.checkpoint.update(self.buffer)
+            with self.db as tx:
+                self.checkpoint.save(tx)
+        latency = time.perf_counter() - t0
+        self.write_time += latency
+        self.max_write_latency = max(self.max_write_latency, latency)
+
+        n_rows = len(self.buffer)
+        self.rows_written += n_rows
+        self.batches_written += 1
+        self.buffer = []
+        return n_rows
+
+    def drain(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time
+        return (f'{self.rows_written} rows in {self.files_written} part files, '
+                f'{self.rows_written / elapsed if elapsed > 0 else 0.0:.1f} rows/sec overall')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error_value, traceback):
+        self.close()
+
+
+def read_partition(day, columns=None, root=partitions_dir, min_part_time=None,
+                   max_part_time=None):
+    '''Read all part files of one day, optionally only those written after
+    min_part_time up to max_part_time.
+
+    Tweets written several times, e.g. by overlapping crawls, keep the row
+    written last so mutable columns are up to date.
+
+    Returns
+    -------
+    pyarrow.Table or None
+        None if the day has no part files in the time range.
+
+    '''
+    read_columns = None
+    if columns is not None:
+        # id_str is needed for deduplication
+        read_columns = [column for column in columns if column != 'created_date']
+        if 'id_str' not in read_columns:
+            read_columns.append('id_str')
+
+    files = part_files(day, root, min_part_time, max_part_time)
+    if not files:
+        return None
+    table = pa.concat_tables([pq.read_table(path, columns=read_columns) for path in files])
+    if len(files) > 1:
+        df = table.to_pandas()
+        df = df.drop_duplicates(subset='id_str', keep='last')
+        table = pa.Table.from_pandas(df, schema=table.schema, preserve_index=False)
+    if columns is not None and 'created_date' in columns:
+        table = table.append_column('created_date', pa.array([str(day)] * len(table)))
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+def pruned_partitions(start_date=None, end_date=None, exclude_dates=(), root=partitions_dir):
+    # days of existing partitions inside the requested date range
+    intervals = date_intervals(start_date, end_date, exclude_dates)
+    return [day for day in list_partitions(root)
+            if any((first is None or first <= day) and (last is None or day <= last)
+                   for first, last in intervals)]
+
+def load_tweets_from_partitions(root=partitions_dir, **kwargs):
+    '''Partitioned counterpart of data_loader.load_tweets_from_db. Only the
+    day partitions inside the requested date range are read, independent of
+    the size of the history.
+
+    Parameters
+    ----------
+    root : str, optional
+        Partitions folder. The default is utils.partitions_dir.
+    **kwargs : query_date str, start_date str, end_date str,
+               exclude_dates list, columns list, compact bool.
+        Same arguments as load_tweets_from_db.
+
+    Returns
+    -------
+    df : pandas DataFrame object.
+
+    '''
+    start_date, end_date, exclude_dates = resolve_date_arguments(kwargs)
+    start_date = parse_date(start_date) if start_date is not None else None
+    end_date = parse_date(end_date) if end_date is not None else None
+    days = pruned_partitions(start_date, end_date,
+                             [parse_date(day) for day in exclude_dates], root)
+
+    columns = kwargs.get('columns', None) or tweet_columns
+    tables = [table for table in (read_partition(day, columns, root) for day in days)
+              if table is not None]
+    if not tables:
+        return parse_coordinates(pd.DataFrame(columns=columns))
+
+    df = parse_coordinates(pa.concat_tables(tables).to_pandas())
+    if kwargs.get('compact', True):
+        df = compact_dtypes(df)
+    return df
+
+def iter_tweets_from_partitions(chunksize=50000, root=partitions_dir, min_part_time=None,
+                                max_part_time=None, **kwargs):
+    '''Partitioned counterpart of data_loader.iter_tweets_from_db yielding
+    DataFrames of at most chunksize rows. Only the day partitions inside the
+    requested date range are read, one day at a time.
+
+    Parameters
+    ----------
+    chunksize : int, optional
+        Maximum number of rows per chunk. The default is 50000.
+    root : str, optional
+        Partitions folder. The default is utils.partitions_dir.
+    min_part_time, max_part_time : int, optional
+        Only read part files written after min_part_time up to
+        max_part_time, see part_time. The default is all part files.
+    **kwargs :
+        Same arguments as load_tweets_from_partitions.
+
+    Yields
+    ------
+    df : pandas DataFrame object.
+        Chunk of tweets with an index continuing over all chunks. A tweet
+        belongs to the partition of its created day, so every tweet is
+        yielded once.
+
+    '''
+    start_date, end_date, exclude_dates = resolve_date_arguments(kwargs)
+    start_date = parse_date(start_date) if start_date is not None else None
+    end_date = parse_date(end_date) if end_date is not None else None
+    days = pruned_partitions(start_date, end_date,
+                             [parse_date(day) for day in exclude_dates], root)
+    columns = kwargs.get('columns', None) or tweet_columns
+
+    def to_frame(table, offset):
+        df = parse_coordinates(table.to_pandas())
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        if kwargs.get('compact', True):
+            df = compact_dtypes(df)
+        return df
+
+    # days are collected until a chunk is full, so small days do not end up
+    # as small chunks
+    pending = []
+    n_pending = 0
+    offset = 0
+    for day in days:
+        table = read_partition(day, columns, root, min_part_time, max_part_time)
+        if table is None or not len(table):
+            continue
+        pending.append(table)
+        n_pending += len(table)
+        while n_pending >= chunksize:
+            table = pa.concat_tables(pending)
+            yield to_frame(table.slice(0, chunksize), offset)
+            offset += chunksize
+            pending = [table.slice(chunksize)]
+            n_pending -= chunksize
+    if n_pending:
+        yield to_frame(pa.concat_tables(pending), offset)
+
+def compact_partitions(older_than_days=7, root=partitions_dir):
+    '''Merge the part files of every day partition older than
+    older_than_days into one deduplicated zstd compressed file. Recent days
+    stay as small part files that are cheap to add to.
+
+    Returns
+    -------
+    int
+        Number of compacted day partitions.
+
+    '''
+    cutoff = date.today() - timedelta(days=older_than_days)
+    n_compacted = 0
+    for day in list_partitions(root):
+        files = part_files(day, root)
+        if day >= cutoff or (len(files) == 1 and
+                             os.path.basename(files[0]).startswith(compacted_prefix)):
+            continue
+
+        # write the merged file before removing the parts, a reader sees
+        # duplicates at worst, which read_partition removes
+        write_part(read_partition(day, root=root).cast(tweet_schema), day, root,
+                   compacted=True)
+        for path in files:
+            os.remove(path)
+        n_compacted += 1
+    return n_compacted
+
+if __name__ == '__main__':
+    print(compact_partitions(), 'partitions compacted')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Offline ingestion of archived twitter API responses stored as (gzipped)
+JSONL files, one status or one search response per line. Rebuilds
+geo_tweets_germany.db without access to the twitter API.
+"""
+import sys
+import gzip
+import json
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from database import connect_writer
+from tweet_store import TweetWriter
+from tweet_store import extract_tweet_json
+
+_DONE = 'done'
+
+# seconds between checks of the parser processes while no rows arrive
+poll_interval = 1
+
+def open_archive(path):
+    # open gzipped archives transparently, plain JSONL otherwise
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def iter_statuses(response):
+    # statuses of one decoded line: search responses wrap their statuses in
+    # a statuses array. Objects that are no status, e.g. delete and limit
+    # notices of the streaming API, are skipped
+    if isinstance(response, dict) and isinstance(response.get('statuses'), list):
+        statuses = response['statuses']
+    else:
+        statuses = [response]
+    for status in statuses:
+        if isinstance(status, dict) and 'user' in status and 'id_str' in status:
+            yield status
+
+def iter_archive(path):
+    '''Stream the rows of a single archive file.
+
+    Lines are decoded one at a time, so memory use does not depend on the
+    size of the archive. A line holds a single status or a search response
+    with its statuses. Empty and undecodable lines and other objects, e.g.
+    delete notices, are skipped.
+
+    Parameters
+    ----------
+    path : str
+        Path of a .jsonl or .jsonl.gz archive.
+
+    Yields
+    ------
+    dict
+        Rows for the tweets table, filtered like the live collector.
+
+    '''
+    with open_archive(path) as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                response = json.loads(line)
+            except ValueError:
+                continue
+
+            for status in iter_statuses(response):
+                row = extract_tweet_json(status)
+                if row is not None:
+                    yield row
+
+def _parse_archive(path, batch_size):
+    # pool worker: decompress and parse one archive and hand the rows to
+    # the writing parent process in batches through the shared queue. The
+    # done message holds the number of rows of the archive
+    n_rows = 0
+    batch = []
+    try:
+        for row in iter_archive(path):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                _rows_queue.put(('rows', path, batch))
+                n_rows += len(batch)
+                batch = []
+    except Exception as e:
+        _rows_queue.put(('error', path, repr(e)))
+    finally:
+        # rows read before an error are written, like in single process mode
+        if batch:
+            _rows_queue.put(('rows', path, batch))
+            n_rows += len(batch)
+        _rows_queue.put((_DONE, path, n_rows))
+
+def _init_worker(rows_queue):
+    global _rows_queue
+    _rows_queue = rows_queue
+
+def replay_archives(paths, db=None, processes=None, batch_size=5000,
+                    partitioned=False):
+    '''Bulk-load archived API responses into the tweets table.
+
+    Archives are decompressed and parsed by a pool of processes, one file
+    per process at a time, while the parent writes the rows in bulk
+    transactions. A bounded queue keeps memory use constant. Archives that
+    fail to read, e.g. truncated files, are reported and skipped after
+    their readable rows, a parser process that dies raises
+    BrokenProcessPool.
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths of .jsonl or .jsonl.gz archives.
+    db : dataset.Database, optional
+        Target database. The default is geo_tweets_germany.db.
+    processes : int, optional
+        Number of parser processes. 1 parses in the calling process. The
+        default is the number of CPUs, but not more than the number of files.
+    batch_size : int, optional
+        Number of rows per bulk insert. The default is 5000.
+    partitioned : bool, optional
+        Write day-partitioned Parquet files instead of the tweets table, see
+        partition_store. The default is False.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+
+    '''
+    if processes is None:
+        processes = min(multiprocessing.cpu_count(), len(paths)) or 1
+    if partitioned:
+        # import here, pyarrow is only needed for partitioned storage
+        from partition_store import PartitionWriter
+        writer = PartitionWriter(batch_size=batch_size)
+    else:
+        writer = TweetWriter(db or connect_writer(), batch_size=batch_size)
+
+    with writer:
+        if processes == 1:
+            for path in paths:
+                n_rows = 0
+                try:
+                    for row in iter_archive(path):
+                        writer.add(row)
+                        n_rows += 1
+                except Exception as e:
+                    print(path, repr(e))
+                print(path, n_rows, 'rows')
+        else:
+            # bound the queue to a few batches per process
+            rows_queue = multiprocessing.Queue(maxsize=2 * processes)
+            with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                     initargs=(rows_queue,)) as executor:
+                futures = [executor.submit(_parse_archive, path, batch_size)
+                           for path in paths]
+                remaining = len(paths)
+                while remaining:
+                    try:
+                        kind, path, payload = rows_queue.get(timeout=poll_interval)
+                    except queue.Empty:
+                        # a killed parser never sends its done message, its
+                        # future fails with BrokenProcessPool instead
+                        for future in futures:
+                            if future.done() and future.exception() is not None:
+                                raise future.exception()
+                        continue
+                    if kind == 'rows':
+                        for row in payload:
+                            writer.add(row)
+                    elif kind == 'error':
+                        print(path, payload)
+                    else:
+                        remaining -= 1
+                        print(path, payload, 'rows')
+
+    print(writer.stats())
+    return writer.rows_written
+
+if __name__ == '__main__':
+    replay_archives(sys.argv[1:])
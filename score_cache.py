@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of sentiment scores. Stores the scores of every tweet in a
+small sqlite database in the cache folder, keyed by the scorer version and
+id_str together with a hash of the cleaned text, so rebuilds only score
+tweets that were never scored by the same scorer or whose cleaned text
+changed.
+
+Run this module to print the number of cached scores per scorer version.
+"""
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import inspect
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from database import busy_timeout
+from geocoder import file_hash
+from sentiment import distinct_scores
+from sentiment import textblob_scores
+from utils import cache_dir
+
+score_cache_db = os.path.join(cache_dir, 'scores.db')
+
+# bump to invalidate the cached scores of all scorers, e.g. after an update
+# of the textblob lexicon. Changes of the scorer module invalidate its
+# scores automatically
+score_cache_version = '1'
+
+def scorer_version(scorer):
+    # cached scores are only valid for the same scorer function, code and
+    # resource files, e.g. lexicons, listed in scorer_resources of its module
+    module = sys.modules[scorer.__module__]
+    sha = hashlib.sha1(score_cache_version.encode())
+    sha.update(f'{scorer.__module__}.{scorer.__qualname__}'.encode())
+    sha.update(inspect.getsource(module).encode())
+    for path in getattr(module, 'scorer_resources', []):
+        sha.update(file_hash(path).encode())
+    return sha.hexdigest()[:16]
+
+def text_hashes(texts):
+    # 64 bit hashes of the texts, stable across processes and string dtypes,
+    # as signed integers for sqlite
+    hashes = pd.util.hash_pandas_object(pd.Series(texts, dtype=object), index=False)
+    return hashes.to_numpy().view(np.int64)
+
+
+class ScoreCache:
+    '''Persistent scores of one scorer by tweet id and cleaned text.
+
+    A cached score is a hit if the tweet id and the hash of its cleaned
+    text match. Scores of other scorer versions are kept in the database,
+    but never returned. Only the cached scores of the ids of a batch are
+    read, so memory is bounded by the batch and not by the cache, new
+    scores are written through to the database.
+
+    Parameters
+    ----------
+    path : str, optional
+        Cache database file. The default is cache/scores.db.
+    scorer : function, optional
+        Scorer of the cached scores, see sentiment.score_columns. The
+        default is sentiment.textblob_scores.
+    version : str, optional
+        Version of the cached scores. The default is scorer_version(scorer).
+
+    '''
+    def __init__(self, path=score_cache_db, scorer=textblob_scores, version=None):
+        self.path = path
+        self.scorer = scorer
+        self.version = version or scorer_version(scorer)
+        self.hits = 0
+        self.misses = 0
+        self.scored = 0
+        self.score_time = 0.0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS scores '
+                             '(version TEXT, id_str INTEGER, text_hash INTEGER, '
+                             'polarity REAL, subjectivity REAL, '
+                             'PRIMARY KEY (version, id_str))')
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=busy_timeout)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _lookup(self, ids):
+        # cached scores of the ids as typed columns, joined through a
+        # temporary table of the ids on the primary key. The temporary
+        # table is dropped with the connection
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TEMP TABLE batch (id_str INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT INTO batch VALUES (?)', zip(np.unique(ids).tolist()))
+            return pd.read_sql_query('SELECT scores.id_str, text_hash, polarity, subjectivity '
+                                     'FROM batch JOIN scores ON scores.version = ? '
+                                     'AND scores.id_str = batch.id_str',
+                                     conn, params=(self.version,),
+                                     dtype={'id_str': np.int64, 'text_hash': np.int64,
+                                            'polarity': np.float64, 'subjectivity': np.float64})
+        finally:
+            conn.close()
+
+    def scores(self, ids, texts, score=None):
+        '''Scores of the texts, scoring only those missing in the cache.
+
+        Parameters
+        ----------
+        ids : array of int or str
+            Tweet ids, id_str.
+        texts : sequence of str
+            Cleaned tweet texts of the ids.
+        score : function, optional
+            Scores the distinct missing texts, e.g. scorer in a process
+            pool. Must return the same scores as the scorer of the cache.
+            The default is the scorer.
+
+        Returns
+        -------
+        scores : numpy array of float64, shape (n, 2)
+            Columns polarity and subjectivity.
+
+        '''
+        ids = np.asarray(ids).astype(np.int64)
+        hashes = text_hashes(texts)
+        cached = self._lookup(ids)
+
+        # hits need the same id and the same cleaned text
+        indexer = pd.Index(cached['id_str']).get_indexer(ids)
+        hit = indexer >= 0
+        hit[hit] = cached['text_hash'].to_numpy()[indexer[hit]] == hashes[hit]
+
+        scores = np.empty((len(ids), 2), dtype=np.float64)
+        scores[hit] = cached[['polarity', 'subjectivity']].to_numpy()[indexer[hit]]
+
+        missing = np.flatnonzero(~hit)
+        if len(missing):
+            t0 = time.perf_counter()
+            scores[missing], n_distinct = distinct_scores([texts[i] for i in missing],
+                                                          score or self.scorer)
+            self.scored += n_distinct
+            self.score_time += time.perf_counter() - t0
+            self._store(ids[missing], hashes[missing], scores[missing])
+
+        self.hits += int(hit.sum())
+        self.misses += len(missing)
+        return scores
+
+    def _store(self, ids, hashes, scores):
+        # the last row wins for ids that occur more than once
+        last = ~pd.Index(ids).duplicated(keep='last')
+        ids, hashes, scores = ids[last], hashes[last], scores[last]
+
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)',
+                                 zip([self.version] * len(ids), ids.tolist(), hashes.tolist(),
+                                     scores[:, 0].tolist(), scores[:, 1].tolist()))
+        finally:
+            conn.close()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def duplication_ratio(self):
+        # share of the misses that were copies of another missing text
+        return 1 - self.scored / self.misses if self.misses else 0.0
+
+    def stats(self):
+        return (f'score cache: {self.hits} hits, {self.misses} misses '
+                f'({self.hit_rate():.1%} hit rate), {self.scored} distinct texts scored '
+                f'({self.duplication_ratio():.1%} duplicates), '
+                f'{self.score_time:.2f} s scoring misses')
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM scores WHERE version = ?',
+                                (self.version,)).fetchone()[0]
+        finally:
+            conn.close()
+
+@lru_cache(maxsize=None)
+def get_score_cache(scorer=textblob_scores):
+    # one cache per scorer and process
+    return ScoreCache(scorer=scorer)
+
+if __name__ == '__main__':
+    cache = get_score_cache()
+    conn = cache._connect()
+    try:
+        counts = conn.execute('SELECT version, COUNT(*) FROM scores GROUP BY version').fetchall()
+    finally:
+        conn.close()
+    for version, count in counts:
+        current = ' (current)' if version == cache.version else ''
+        print(f'{version}: {count} cached scores{current}')
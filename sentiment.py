@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Sentiment scoring of cleaned tweet texts.
+
+Scorers take a sequence of texts and return a float64 array of shape
+(n, 2) holding the columns of score_columns, polarity in [-1, 1] and
+subjectivity in [0, 1], in the order of the texts. Every text is analyzed
+once for both scores. Scorers are module level functions, so they can be
+sent to worker processes, and are registered by name in scorers.
+parallel_scores runs a scorer on chunks of the texts in a process pool of
+scoring_pool, created once per build, distinct_scores scores every distinct
+text only once.
+"""
+import os
+import multiprocessing
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from lexicon_scorer import sentiws_scores
+
+# columns of the score arrays returned by scorers
+score_columns = ['polarity', 'subjectivity']
+
+@lru_cache(maxsize=None)
+def get_pattern_sentiment():
+    # the pattern lexicon scorer behind TextBlob(text).sentiment, loaded once
+    # per process. Import here, the lexicon is only needed for scoring
+    from textblob.en import sentiment
+    return sentiment
+
+def textblob_scores(texts):
+    '''Polarity and subjectivity of the TextBlob PatternAnalyzer.
+
+    Same scores as TextBlob(text).sentiment. The lexicon scorer of the
+    analyzer is called directly, without building a TextBlob and a
+    namedtuple class per text.
+
+    Parameters
+    ----------
+    texts : sequence of str
+        Cleaned tweet texts.
+
+    Returns
+    -------
+    scores : numpy array of float64, shape (n, 2)
+        Columns polarity and subjectivity.
+
+    '''
+    pattern_sentiment = get_pattern_sentiment()
+    scores = np.empty((len(texts), 2), dtype=np.float64)
+    for i, text in enumerate(texts):
+        scores[i] = pattern_sentiment(text)
+    return scores
+
+def _init_worker(scorer):
+    # load the model of the scorer once per worker process, later chunks
+    # reuse it. Forked workers inherit the model loaded by scoring_pool
+    scorer([''])
+
+@contextmanager
+def scoring_pool(scorer=textblob_scores, processes=None):
+    '''Process pool for parallel_scores, shared by all chunks of a build.
+
+    The model of the scorer is loaded in the calling process first, so
+    forked workers share it, and once per worker otherwise.
+
+    Parameters
+    ----------
+    scorer : function, optional
+        Module level scorer function, see score_columns. The default is
+        textblob_scores.
+    processes : int, optional
+        Number of worker processes. The default is the number of CPUs.
+
+    Yields
+    ------
+    pool : multiprocessing.Pool or None
+        None for a single process, parallel_scores then scores in the
+        calling process.
+
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    scorer([''])
+    if processes <= 1:
+        yield None
+        return
+    with multiprocessing.Pool(processes, initializer=_init_worker,
+                              initargs=(scorer,)) as pool:
+        yield pool
+
+def parallel_scores(texts, scorer=textblob_scores, pool=None, chunksize=5000):
+    '''Score texts in chunks in a process pool.
+
+    The chunks are scored in parallel and the results are put together in
+    the order of the texts, the scores are the same as of scorer(texts).
+
+    Parameters
+    ----------
+    texts : sequence of str
+        Cleaned tweet texts.
+    scorer : function, optional
+        Module level scorer function, see score_columns. The default is
+        textblob_scores.
+    pool : multiprocessing.Pool, optional
+        Pool of scoring_pool. None, or texts of a single chunk, are scored
+        in the calling process. The default is None.
+    chunksize : int, optional
+        Number of texts per chunk. The default is 5000.
+
+    Returns
+    -------
+    scores : numpy array of float64, shape (n, 2)
+        Columns polarity and subjectivity.
+
+    '''
+    texts = list(texts)
+    if pool is None or len(texts) <= chunksize:
+        return scorer(texts)
+
+    chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+    # map returns the results in the order of the chunks
+    return np.concatenate(pool.map(scorer, chunks))
+
+def distinct_scores(texts, score=textblob_scores):
+    '''Score every distinct text once and scatter the scores to the texts.
+
+    Retweets and copied tweets share their cleaned text, the scores of the
+    distinct texts are taken for all copies.
+
+    Parameters
+    ----------
+    texts : sequence of str
+        Cleaned tweet texts.
+    score : function, optional
+        Scorer, or a scorer in a process pool, see parallel_scores. The
+        default is textblob_scores.
+
+    Returns
+    -------
+    scores : numpy array of float64, shape (n, 2)
+        Columns polarity and subjectivity.
+    n_distinct : int
+        Number of distinct texts scored.
+
+    '''
+    codes, uniques = pd.factorize(np.asarray(texts, dtype=object))
+    return np.take(score(uniques.tolist()), codes, axis=0), len(uniques)
+
+# registered scorers by name, see get_scorer
+scorers = {'textblob': textblob_scores,
+           'sentiws': sentiws_scores}
+
+# environment variable of the scorer name of get_scorer
+scorer_variable = 'GEOSENTIMENT_SCORER'
+
+# texts get_scorer scores to check the selected scorer
+sample_texts = ['', 'Corona', 'great news', 'schlimme Zahlen, gute Nachrichten']
+
+def register_scorer(name, scorer):
+    # add a module level scorer function to the registry, see score_columns
+    scorers[name] = scorer
+
+def get_scorer(name=None):
+    '''Registered scorer by name.
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the scorer in scorers. The default is the value of the
+        GEOSENTIMENT_SCORER environment variable, else 'textblob'.
+
+    Returns
+    -------
+    scorer : function
+        Scorer function, see score_columns. The scorer is checked with
+        check_scores on sample_texts, so a broken scorer fails when it is
+        selected and not in the middle of a build.
+
+    '''
+    name = name or os.environ.get(scorer_variable, 'textblob')
+    if name not in scorers:
+        raise ValueError(f'unknown scorer {name!r}, registered scorers: {", ".join(scorers)}')
+    scorer = scorers[name]
+    check_scores(scorer(sample_texts), len(sample_texts))
+    return scorer
+
+def check_scores(scores, n_texts):
+    # raise if a scorer breaks the batch in, arrays out contract
+    scores = np.asarray(scores)
+    if scores.shape != (n_texts, 2) or scores.dtype != np.float64:
+        raise ValueError(f'expected float64 scores of shape ({n_texts}, 2), '
+                         f'got {scores.dtype} of shape {scores.shape}')
+    polarity = scores[:, score_columns.index('polarity')]
+    subjectivity = scores[:, score_columns.index('subjectivity')]
+    if not (np.all(np.abs(polarity) <= 1) and np.all((subjectivity >= 0) & (subjectivity <= 1))):
+        raise ValueError('scores out of range, polarity must be in [-1, 1] '
+                         'and subjectivity in [0, 1]')
+    return scores
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar snapshot cache of the geocoded and sentiment scored tweets. The
+processed frame is stored as Arrow IPC file in the cache folder and memory
+mapped on later builds, only the requested columns are converted to pandas.
+Only tweets written to the database, or to the day partitions of
+partition_store, since the last snapshot are processed again.
+"""
+import os
+import json
+import hashlib
+import inspect
+
+import pandas as pd
+import pyarrow as pa
+
+import data_loader
+import data_processing
+import geocoder
+import partition_store
+import sentiment
+import state_join
+
+from database import reader
+from data_loader import compact_dtypes
+from data_loader import iter_tweets_from_db
+from data_processing import process_tweet_chunks
+from partition_store import iter_tweets_from_partitions
+from partition_store import partitions_state
+from location_cache import get_location_cache
+from score_cache import get_score_cache
+from score_cache import scorer_version
+from sentiment import scoring_pool
+from sentiment import textblob_scores
+
+from utils import cache_dir
+
+# bump to invalidate all snapshots. Changes of the code of pipeline_modules
+# or of the pipeline_resources files invalidate snapshots automatically
+pipeline_version = '1'
+pipeline_modules = [data_loader, data_processing, geocoder, partition_store, sentiment,
+                    state_join]
+pipeline_resources = [geocoder.cities_csv, state_join.states_shp]
+
+def pipeline_hash(scorer=textblob_scores):
+    # hash of the pipeline version, the source code of the processing
+    # modules, the resource files and the sentiment scorer, a snapshot is
+    # only reused by the same pipeline
+    sha = hashlib.sha1(pipeline_version.encode())
+    sha.update(scorer_version(scorer).encode())
+    for module in pipeline_modules:
+        sha.update(inspect.getsource(module).encode())
+    for path in pipeline_resources:
+        sha.update(geocoder.file_hash(path).encode())
+    return sha.hexdigest()
+
+def snapshot_path(**kwargs):
+    # one snapshot per set of loader arguments
+    key = hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    return os.path.join(cache_dir, f'tweets_{key.hexdigest()[:12]}.arrow')
+
+def database_state():
+    # max rowid of the tweets table
+    with reader() as conn:
+        max_rowid, = conn.execute('SELECT MAX(rowid) FROM tweets').fetchone()
+    return max_rowid or 0
+
+def storage_state(partitioned=False, position=None):
+    '''Position of the newest stored tweets and a fingerprint of the tweets
+    stored up to position, the default is all tweets.
+
+    The position is the max rowid of the tweets table or the write time of
+    the newest part file of the partitions. A different fingerprint of the
+    tweets up to a snapshot position means they were rewritten, e.g. by
+    compact_partitions. Rewrites of the tweets table lower its max rowid
+    instead and have no fingerprint.
+    '''
+    if partitioned:
+        return partitions_state(max_part_time=position)
+    return database_state(), ''
+
+def stream_tweets(partitioned=False, since=None, until=None, **kwargs):
+    # chunks of the tweets stored after position since up to until, from
+    # the tweets table or from the partitions
+    if partitioned:
+        return iter_tweets_from_partitions(min_part_time=since, max_part_time=until, **kwargs)
+    return iter_tweets_from_db(min_rowid=since, max_rowid=until, **kwargs)
+
+def read_snapshot(path):
+    '''Memory map a snapshot file.
+
+    Returns
+    -------
+    table : pyarrow Table object or None
+        Snapshot table, None if the file does not exist. The columns
+        reference the mapped pages, nothing is read before the columns are
+        converted, see snapshot_frame.
+    meta : dict
+        Snapshot metadata, i.e. pipeline_hash, position and fingerprint,
+        see storage_state.
+
+    '''
+    if not os.path.exists(path):
+        return None, {}
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    meta = {key.decode(): value.decode()
+            for key, value in (table.schema.metadata or {}).items()}
+    return table.replace_schema_metadata(None), meta
+
+def snapshot_frame(table, columns=None):
+    # convert the snapshot table to pandas, only the given columns are
+    # copied out of the mapped file
+    if columns is not None:
+        table = table.select([column for column in columns if column in table.column_names])
+    return table.to_pandas()
+
+def select_columns(df, columns=None):
+    # columns of a processed frame, columns missing in df are skipped
+    if columns is None:
+        return df
+    return df[[column for column in columns if column in df.columns]]
+
+def write_snapshot(df, path, meta):
+    # write the compacted frame and the metadata to a temporary file first,
+    # the rename makes the update atomic for concurrent builds
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({key: str(value) for key, value in meta.items()})
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+
+def to_snapshot_dtypes(df):
+    # compact dtypes are stored as typed arrow columns, categoricals as
+    # dictionary arrays
+    return compact_dtypes(df).reset_index(drop=True)
+
+def process_tweets(processes=1, scorer=textblob_scores, partitioned=False, since=None,
+                   until=None, **kwargs):
+    # load, geocode and score tweets chunk by chunk, all chunks are scored
+    # by the same pool, so every worker loads the scorer model only once
+    tweets = stream_tweets(partitioned, since, until, **kwargs)
+    with scoring_pool(scorer, processes) as pool:
+        chunks = list(process_tweet_chunks(tweets, pool, scorer))
+    print(get_location_cache().stats())
+    print(get_score_cache(scorer).stats())
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+def load_enriched_tweets(processes=1, scorer=textblob_scores, output_columns=None,
+                         partitioned=False, **kwargs):
+    '''Load the geocoded and sentiment scored tweets through the snapshot
+    cache.
+
+    The snapshot is reused as long as the pipeline hash matches. Tweets
+    stored after the position of the snapshot, see storage_state, are
+    processed and appended. If the database max rowid went down, e.g. after
+    compact_tweets, partitions were compacted or the pipeline changed, the
+    snapshot is rebuilt. Mutable columns of already cached tweets are not
+    refreshed by appends.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of sentiment scoring processes, None for the number of CPUs.
+        The default is 1.
+    scorer : function, optional
+        Module level sentiment scorer, see sentiment_analysis. Every scorer
+        has its own snapshot. The default is textblob_scores.
+    output_columns : list, optional
+        Columns of the returned frame. Columns of an up to date snapshot
+        that are left out are never read from the file. The default is all
+        columns.
+    partitioned : bool, optional
+        Read the tweets from the day partitions of partition_store instead
+        of the tweets table. Date arguments only read the partitions of
+        their days. The default is False.
+    **kwargs :
+        Loader arguments, see load_tweets_from_db and
+        load_tweets_from_partitions.
+
+    Returns
+    -------
+    df : pandas DataFrame object.
+        Tweets with user_location_cleaned, longitude, latitude, state,
+        subjectivity and polarity columns.
+
+    '''
+    path = snapshot_path(scorer=scorer.__name__, partitioned=partitioned, **kwargs)
+    current_hash = pipeline_hash(scorer)
+    position, fingerprint = storage_state(partitioned)
+
+    table, meta = read_snapshot(path)
+    if table is not None and meta.get('pipeline_hash') == current_hash:
+        snapshot_position = int(meta['position'])
+        if snapshot_position == position:
+            print('snapshot up to date', path)
+            return snapshot_frame(table, output_columns)
+        unchanged = storage_state(partitioned, snapshot_position)[1] == meta['fingerprint']
+        if snapshot_position < position and unchanged:
+            # process the new tweets only. The upper bound keeps tweets
+            # written during the build for the next append
+            new = process_tweets(processes, scorer, partitioned, since=snapshot_position,
+                                 until=position, **kwargs)
+            print(len(new), 'new tweets appended to snapshot', path)
+            df = snapshot_frame(table)
+            if len(new):
+                df = to_snapshot_dtypes(pd.concat([df, new], ignore_index=True))
+                df = df.drop_duplicates(subset='id_str', keep='first', ignore_index=True)
+            write_snapshot(df, path, dict(pipeline_hash=current_hash, position=position,
+                                          fingerprint=fingerprint))
+            return select_columns(df, output_columns)
+
+    # no valid snapshot: process the full history
+    print('rebuilding snapshot', path)
+    df = process_tweets(processes, scorer, partitioned, until=position, **kwargs)
+    if len(df):
+        df = to_snapshot_dtypes(df)
+        write_snapshot(df, path, dict(pipeline_hash=current_hash, position=position,
+                                      fingerprint=fingerprint))
+    return select_columns(df, output_columns)
+
+if __name__ == '__main__':
+    df = load_enriched_tweets()
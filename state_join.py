@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial join of the tweet locations with the german states (Bundesländer) of
+shapefiles_ger/DEU_adm1.shp, and state level aggregates of tweet counts and
+sentiment.
+
+The state polygons are split into their parts and indexed by a shapely
+STRtree, built once per process. The geometries are cached as WKB in the
+cache folder, so the shapefile is only read again after it changed.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+
+from geocoder import file_hash
+
+from utils import cache_dir
+from utils import resources_dir
+
+states_shp = os.path.join(resources_dir, 'shapefiles_ger', 'DEU_adm1.shp')
+states_cache = os.path.join(cache_dir, 'states.npz')
+
+# points outside of all states, e.g. on islands cut off by the simplified
+# coast line, are assigned to the nearest state within this distance in
+# degrees
+max_nearest_distance = 0.1
+
+# tolerance in degrees of the simplified polygons used for the distances of
+# points outside of all states
+outline_tolerance = 0.005
+
+
+class StateIndex:
+    '''Point in polygon lookup of the german states.
+
+    Parameters
+    ----------
+    names : array of str
+        State names, NAME_1 of the shapefile.
+    geometries : array of shapely geometries
+        State polygons or multipolygons, in longitude, latitude.
+
+    '''
+    def __init__(self, names, geometries):
+        self.names = np.asarray(names, dtype=object)
+        self.geometries = np.asarray(geometries)
+
+        # one tree entry per polygon part: the bounding boxes of the parts
+        # are much tighter than those of whole states
+        self.parts, self.part_states = shapely.get_parts(self.geometries, return_index=True)
+        shapely.prepare(self.parts)
+        self.tree = STRtree(self.parts)
+        
+        # distances to the detailed polygons are expensive, the fallback for
+        # points outside of all states uses simplified ones
+        self.outlines = shapely.simplify(self.parts, outline_tolerance)
+
+    @classmethod
+    def from_shapefile(cls, path=states_shp):
+        # import here, geopandas is only needed to rebuild the cache
+        import geopandas as gpd
+        sf = gpd.read_file(path)
+        return cls(sf['NAME_1'].to_numpy(dtype=str), sf.geometry.to_numpy())
+
+    @classmethod
+    def load(cls, path=states_cache, shp_path=states_shp):
+        '''Load the state geometries from the WKB cache, rebuild the cache
+        from the shapefile if it is missing or the shapefile changed.'''
+        shp_hash = file_hash(shp_path)
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                if str(cached['shp_hash']) == shp_hash:
+                    return cls(cached['names'], shapely.from_wkb(cached['wkb']))
+
+        index = cls.from_shapefile(shp_path)
+        index.save(path, shp_hash)
+        return index
+
+    def save(self, path, shp_hash=''):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_path,
+                 names=self.names.astype(str),
+                 wkb=shapely.to_wkb(self.geometries, hex=True).astype(str),
+                 shp_hash=np.array(shp_hash))
+        os.replace(tmp_path, path)
+
+    def lookup(self, longitude, latitude):
+        '''Find the state of every point in batched tree queries.
+
+        Parameters
+        ----------
+        longitude, latitude : array of float
+            Points in degrees.
+
+        Returns
+        -------
+        positions : numpy array of int
+            Index of the state in names, -1 for points outside of Germany.
+
+        '''
+        longitude = np.asarray(longitude, dtype=np.float64)
+        latitude = np.asarray(latitude, dtype=np.float64)
+        positions = np.full(len(longitude), -1, dtype=np.int64)
+
+        # candidate parts by bounding box from the tree, then one vectorized
+        # exact test of all point and part pairs with the prepared parts
+        point_idx, part_idx = self.tree.query(shapely.points(longitude, latitude))
+        inside = shapely.contains_xy(self.parts[part_idx], longitude[point_idx], latitude[point_idx])
+        positions[point_idx[inside]] = self.part_states[part_idx[inside]]
+
+        outside = np.flatnonzero(positions < 0)
+        if len(outside):
+            # parts with a bounding box within max_nearest_distance, the
+            # nearest one within that distance wins
+            d = max_nearest_distance
+            boxes = shapely.box(longitude[outside] - d, latitude[outside] - d,
+                                longitude[outside] + d, latitude[outside] + d)
+            box_idx, part_idx = self.tree.query(boxes)
+            distances = shapely.distance(self.outlines[part_idx],
+                                         shapely.points(longitude[outside[box_idx]],
+                                                        latitude[outside[box_idx]]))
+            near = distances <= d
+            box_idx, part_idx, distances = box_idx[near], part_idx[near], distances[near]
+            order = np.lexsort((distances, box_idx))
+            first = order[np.unique(box_idx[order], return_index=True)[1]]
+            positions[outside[box_idx[first]]] = self.part_states[part_idx[first]]
+        return positions
+
+@lru_cache(maxsize=None)
+def get_state_index():
+    # one state index per process
+    return StateIndex.load()
+
+def add_states(df):
+    '''Add the state column to the geocoded tweets of df.
+
+    All tweets of a city share its coordinates, so only the distinct
+    coordinates are joined and the states are scattered back to the rows.
+    Note that the longitude column holds the latitudes and vice versa, see
+    geocoder.Geocoder.
+    '''
+    index = get_state_index()
+    points = pd.MultiIndex.from_arrays([df['latitude'], df['longitude']])
+    codes, uniques = pd.factorize(points)
+    positions = index.lookup(uniques.get_level_values(0), uniques.get_level_values(1))
+
+    names = np.append(index.names, None)
+    df['state'] = names[positions[codes]]
+    return df
+
+def _aggregate(df, keys):
+    grouped = df.assign(positive=df['polarity'] > 0).groupby(keys, observed=True, sort=True)
+    return grouped.agg(tweet_count=('polarity', 'size'),
+                       polarity_mean=('polarity', 'mean'),
+                       subjectivity_mean=('subjectivity', 'mean'),
+                       positive_share=('positive', 'mean')).reset_index()
+
+def state_day_aggregates(df):
+    '''Tweet counts and sentiment aggregates per state and day.
+
+    Parameters
+    ----------
+    df : pandas DataFrame object.
+        Tweets with state, created, polarity and subjectivity columns.
+
+    Returns
+    -------
+    pandas DataFrame object.
+        One row per state and day with tweet_count, polarity_mean,
+        subjectivity_mean and positive_share, the share of tweets with
+        positive polarity. Tweets without state are left out.
+
+    '''
+    days = pd.to_datetime(df['created']).dt.date.rename('date_created')
+    return _aggregate(df, [df['state'].astype(object), days])
+
+def state_aggregates(df):
+    '''Tweet counts and sentiment aggregates per state over all days, same
+    columns as state_day_aggregates without date_created.'''
+    return _aggregate(df, df['state'].astype(object))
+
+if __name__ == '__main__':
+    from snapshot_cache import load_enriched_tweets
+    print(state_aggregates(load_enriched_tweets()).to_string(index=False))
@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+Write side of the tweet database. Buffers extracted tweet rows and stores
+them in bulk inside a single transaction per batch, together with the
+collection checkpoints used to resume incremental crawls.
+
+Run this module to compact an existing geo_tweets_germany.db: duplicate
+tweets are removed and the unique id_str index required for upserts is
+created.
+"""
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+from datetime import timezone
+
+from sqlalchemy.dialects.sqlite import insert
+
+from database import connect_writer
+
+# columns refreshed when an already stored tweet is written again
+mutable_columns = ['retweet_count', 'user_followers']
+
+
+def parse_twitter_datetime(value):
+    # convert twitter API timestamps, e.g. 'Wed May 06 12:34:56 +0000 2020',
+    # to naive UTC datetime objects like the ones returned by tweepy
+    if value is None:
+        return None
+    parsed = datetime.strptime(value, '%a %b %d %H:%M:%S %z %Y')
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+def extract_tweet_json(status):
+    '''Extract the stored fields of a raw twitter API status.
+
+    Used by the live collector and by the offline replay of archived API
+    responses, so both apply the same fields and filter.
+
+    Parameters
+    ----------
+    status : dict
+        Decoded JSON of a single status.
+
+    Returns
+    -------
+    dict or None
+        Row for the tweets table. None if the tweet has neither a user
+        location nor coordinates.
+
+    '''
+    user = status['user']
+    
+    coords = status.get('coordinates')
+    if coords is not None:
+        coords = json.dumps(coords)
+    
+    loc = user.get('location')
+    if not (loc or coords is not None):
+        return None
+    
+    # extended mode responses carry full_text, streamed statuses keep the
+    # untruncated text in extended_tweet
+    text = (status.get('full_text')
+            or status.get('extended_tweet', {}).get('full_text')
+            or status.get('text'))
+    
+    return dict(created=parse_twitter_datetime(status['created_at']),
+                user_name=user.get('screen_name'),
+                
+                user_location=loc,
+                coordinates=coords,
+                
+                user_description=user.get('description'),
+                text=text,
+                
+                id_str=status['id_str'],
+                retweet_count=status.get('retweet_count'),
+                user_followers=user.get('followers_count'),
+                user_created=parse_twitter_datetime(user.get('created_at')),)
+
+
+class Checkpoint:
+    '''Collection progress for one search query and geocode.
+
+    since_id is the high-water mark of all completed runs: later runs only
+    fetch tweets newer than it. While a run is in progress, max_id holds the
+    lowest tweet id written so far and newest_id the highest one, so an
+    interrupted backfill can continue below max_id instead of starting over.
+
+    Parameters
+    ----------
+    query : str
+        Search query of the collection.
+    geocode : str
+        Geocode of the collection.
+    since_id, max_id, newest_id : int, optional
+        Stored tweet ids, None if not set.
+
+    '''
+    table_name = 'checkpoints'
+
+    def __init__(self, query, geocode, since_id=None, max_id=None, newest_id=None):
+        self.query = query
+        self.geocode = geocode
+        self.since_id = since_id
+        self.max_id = max_id
+        self.newest_id = newest_id
+
+    @classmethod
+    def load(cls, db, query, geocode):
+        # return the stored checkpoint for query and geocode or an empty one
+        # if the collection has never been run
+        if cls.table_name not in db.tables:
+            return cls(query, geocode)
+        row = db[cls.table_name].find_one(query=query, geocode=geocode)
+        if row is None:
+            return cls(query, geocode)
+        
+        def to_id(value):
+            return int(value) if value is not None else None
+        
+        return cls(query, geocode,
+                   since_id=to_id(row['since_id']),
+                   max_id=to_id(row['max_id']),
+                   newest_id=to_id(row['newest_id']))
+
+    def cursor_kwargs(self):
+        # since_id/max_id arguments for the search cursor. An unfinished
+        # backfill resumes below the lowest tweet written so far
+        kwargs = {}
+        if self.since_id is not None:
+            kwargs['since_id'] = self.since_id
+        if self.max_id is not None:
+            kwargs['max_id'] = self.max_id - 1
+        return kwargs
+
+    def update(self, rows):
+        # track the id range of rows written during the current run
+        ids = [int(row['id_str']) for row in rows]
+        if not ids:
+            return
+        self.max_id = min(ids) if self.max_id is None else min(self.max_id, *ids)
+        self.newest_id = max(ids) if self.newest_id is None else max(self.newest_id, *ids)
+
+    def complete(self):
+        # the run reached the end of the cursor: move the high-water mark to
+        # the newest tweet of the run and clear the backfill position
+        if self.newest_id is not None:
+            self.since_id = max(self.since_id or 0, self.newest_id)
+        self.max_id = None
+        self.newest_id = None
+
+    def save(self, db):
+        types = {'since_id': db.types.bigint,
+                 'max_id': db.types.bigint,
+                 'newest_id': db.types.bigint}
+        db[self.table_name].upsert(dict(query=self.query,
+                                        geocode=self.geocode,
+                                        since_id=self.since_id,
+                                        max_id=self.max_id,
+                                        newest_id=self.newest_id),
+                                   ['query', 'geocode'],
+                                   types=types)
+
+
+def create_id_index(db, table_name='tweets'):
+    '''Create the unique index on id_str used as upsert conflict target.
+
+    Raises
+    ------
+    ValueError
+        If the table still contains duplicate tweets. Run compact_tweets
+        once to remove them.
+
+    '''
+    table = db[table_name]
+    if table.has_index(['id_str']):
+        return
+    duplicates = next(iter(db.query(f'''SELECT COUNT(*) - COUNT(DISTINCT id_str)
+                                       AS n FROM {table_name}''')))['n']
+    if duplicates:
+        raise ValueError(f'{table_name} contains {duplicates} duplicate tweets, '
+                         'run compact_tweets (python tweet_store.py) first')
+    table.create_index(['id_str'], name=f'ix_{table_name}_id_str', unique=True)
+
+def compact_tweets(db, table_name='tweets'):
+    '''One-time compaction of a database written before upserts.
+
+    Keeps the first stored row of every id_str, refreshed with the mutable
+    columns of its latest duplicate, deletes the other duplicates, creates
+    the unique id_str index and reclaims the freed space.
+
+    Returns
+    -------
+    int
+        Number of deleted rows.
+
+    '''
+    table = db[table_name]
+    n_before = len(table)
+    
+    # temporary non unique index makes the correlated lookups cheap
+    db.query(f'CREATE INDEX IF NOT EXISTS ix_compact_id_str ON {table_name} (id_str)')
+    with db as tx:
+        set_columns = ', '.join(mutable_columns)
+        tx.query(f'''UPDATE {table_name} SET ({set_columns}) =
+                    (SELECT {set_columns} FROM {table_name} AS latest
+                     WHERE latest.id_str = {table_name}.id_str
+                     ORDER BY latest.id DESC LIMIT 1)
+                    WHERE id_str IN (SELECT id_str FROM {table_name}
+                                     GROUP BY id_str HAVING COUNT(*) > 1)''')
+        tx.query(f'''DELETE FROM {table_name} WHERE id NOT IN
+                    (SELECT MIN(id) FROM {table_name} GROUP BY id_str)''')
+    db.query('DROP INDEX IF EXISTS ix_compact_id_str')
+    create_id_index(db, table_name)
+    db.query('VACUUM')
+    
+    return n_before - len(table)
+
+
+class TweetWriter:
+    '''Buffered writer for the tweets table of a dataset database.
+
+    Rows are collected with add() and written with one bulk upsert inside a
+    single transaction whenever batch_size rows are buffered or flush() is
+    called explicitly, e.g. at the end of every API page. Tweets that are
+    already stored only get their mutable_columns refreshed.
+
+    Parameters
+    ----------
+    db : dataset.Database
+        Database connection the rows are written to.
+    table_name : str, optional
+        Name of the target table. The default is 'tweets'.
+    batch_size : int, optional
+        Number of buffered rows that trigger an automatic flush. None only
+        flushes on explicit flush() calls. The default is None.
+    checkpoint : Checkpoint, optional
+        Collection checkpoint that is updated and saved in the same
+        transaction as every written batch. The default is None.
+
+    '''
+    def __init__(self, db, table_name='tweets', batch_size=None, checkpoint=None):
+        self.db = db
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.schema_ready = False
+        self.buffer = []
+        self.rows_written = 0
+        self.batches_written = 0
+        self.write_time = 0.0
+        self.max_write_latency = 0.0
+        self.start_time = time.perf_counter()
+
+    def add(self, row):
+        # buffer a single row and flush if the configured batch size is hit
+        self.buffer.append(row)
+        if self.batch_size and len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def _ensure_schema(self):
+        # create missing columns by example of the buffered rows and the
+        # unique id_str index once, before the first write
+        table = self.db[self.table_name]
+        for column in self.buffer[0]:
+            if not table.has_column(column):
+                example = next((row[column] for row in self.buffer
+                                if row.get(column) is not None), None)
+                table.create_column_by_example(column, example)
+        create_id_index(self.db, self.table_name)
+        self.schema_ready = True
+
+    def _upsert_statement(self, table):
+        statement = insert(table.table)
+        return statement.on_conflict_do_update(
+            index_elements=['id_str'],
+            set_={column: statement.excluded[column] for column in mutable_columns})
+
+    def flush(self):
+        # write all buffered rows with one bulk upsert in one transaction.
+        # The dataset context manager commits on success and rolls back on
+        # errors, in which case the rows stay buffered for a retry. The
+        # checkpoint is stored in the same transaction so it never points
+        # past rows that were not written
+        if not self.buffer:
+            return 0
+        if not self.schema_ready:
+            self._ensure_schema()
+        t0 = time.perf_counter()
+        with self.db as tx:
+            table = tx[self.table_name]
+            tx.executable.execute(self._upsert_statement(table), self.buffer)
+            if self.checkpoint is not None:
+                self.checkpoint.update(self.buffer)
+                self.checkpoint.save(tx)
+        latency = time.perf_counter() - t0
+        self.write_time += latency
+        self.max_write_latency = max(self.max_write_latency, latency)
+
+        n_rows = len(self.buffer)
+        self.rows_written += n_rows
+        self.batches_written += 1
+        self.buffer = []
+        return n_rows
+
+    def drain(self):
+        # block until all added rows are written
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    @property
+    def rows_per_sec(self):
+        # rows written per second of wall-clock time since the writer started
+        elapsed = time.perf_counter() - self.start_time
+        return self.rows_written / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def write_rows_per_sec(self):
+        # rows written per second spent inside the database writes only
+        return self.rows_written / self.write_time if self.write_time > 0 else 0.0
+
+    def stats(self):
+        return (f'{self.rows_written} rows in {self.batches_written} batches, '
+                f'{self.rows_per_sec:.1f} rows/sec overall, '
+                f'{self.write_rows_per_sec:.1f} rows/sec write')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error_value, traceback):
+        # flush whatever is buffered, also on TweepError or KeyboardInterrupt
+        self.close()
+
+
+class BackgroundTweetWriter:
+    '''Producer/consumer front end of TweetWriter.
+
+    add() puts rows on a bounded queue which is drained by a single writer
+    thread into the database in batches, so API paging does not wait for
+    disk writes. A full queue blocks add() until the writer catches up.
+
+    Parameters
+    ----------
+    db : dataset.Database
+        Database connection the rows are written to.
+    table_name : str, optional
+        Name of the target table. The default is 'tweets'.
+    batch_size : int, optional
+        Maximum number of rows per bulk insert. The default is 1000.
+    checkpoint : Checkpoint, optional
+        Collection checkpoint saved with every written batch. The default is
+        None.
+    maxsize : int, optional
+        Queue bound in rows. The default is 10000.
+
+    '''
+    _FLUSH = object()
+    _STOP = object()
+
+    def __init__(self, db, table_name='tweets', batch_size=1000, checkpoint=None,
+                 maxsize=10000):
+        self.writer = TweetWriter(db, table_name=table_name,
+                                  batch_size=batch_size, checkpoint=checkpoint)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.max_queue_depth = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='tweet-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # drain the queue greedily: wait for one item, then take whatever is
+        # already queued up to batch_size items and write it in one batch
+        stop = False
+        while not stop:
+            items = [self.queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in items:
+                if item is self._STOP:
+                    stop = True
+                elif item is not self._FLUSH:
+                    self.writer.buffer.append(item)
+            try:
+                # after an error keep consuming so producers never block on
+                # a full queue, all rows stay buffered in the writer for
+                # the retry of close()
+                if self.error is None:
+                    self.writer.flush()
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def add(self, row):
+        self._put(row)
+
+    def flush(self):
+        # mark a batch boundary, e.g. the end of an API page, without waiting
+        self._put(self._FLUSH)
+
+    def drain(self):
+        # block until every queued row is written
+        self._put(self._FLUSH)
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # stop the writer thread after it wrote all queued rows. After a
+        # failed batch, it and all rows queued later are retried once from
+        # the calling thread
+        self.queue.put(self._STOP)
+        self.thread.join()
+        if self.error is not None:
+            self.writer.flush()
+            self.error = None
+
+    @property
+    def rows_written(self):
+        return self.writer.rows_written
+
+    def stats(self):
+        batches = self.writer.batches_written
+        mean_latency = self.writer.write_time / batches if batches else 0.0
+        return (f'{self.writer.stats()}, '
+                f'queue depth {self.queue.qsize()} (max {self.max_queue_depth}), '
+                f'write latency {mean_latency * 1000:.1f} ms '
+                f'(max {self.writer.max_write_latency * 1000:.1f} ms)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error_value, traceback):
+        self.close()
+
+if __name__ == '__main__':
+    db = connect_writer()
+    print(compact_tweets(db), 'duplicate tweets removed')
@@ -7,76 +7,276 @@ Created on Fri May  1 15:52:20 2020
 import os
 import json
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import tweepy
-import dataset
 
 from utils import resources_dir
 
-def collect_tweets():
+from database import connect_writer
+
+from tweet_store import BackgroundTweetWriter
+from tweet_store import Checkpoint
+from tweet_store import TweetWriter
+from tweet_store import extract_tweet_json
+
+geocode_germany = "51.163361,10.447683,450km"
+search_terms = ["#Corona", "#Coronavirus", "#covid19", "#Coronakrise",
+                "#sarscov2", "#SARS-CoV-2", "#CoronaCrisis", "#SARS-CoV2",
+                "Pandemie"]
+
+class TokenBucket:
+    '''Thread-safe token bucket limiting the rate of API requests shared by
+    several collector threads.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    capacity : int
+        Maximum number of tokens, i.e. the allowed burst of requests.
+
+    '''
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available and take it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def create_api():
+    # authenticate with the credentials stored in the resources folder
     with open(os.path.join(resources_dir, 'twitter_credentials.json'), "r") as file:
         creds = json.load(file)
     
     auth = tweepy.OAuthHandler(creds['CONSUMER_KEY'], creds['CONSUMER_SECRET'])
     auth.set_access_token(creds['ACCESS_TOKEN'], creds['ACCESS_SECRET'])
-    api = tweepy.API(auth, wait_on_rate_limit=True)
-    db = dataset.connect("sqlite:///geo_tweets_germany.db")
-    
+    return tweepy.API(auth, wait_on_rate_limit=True)
+
+def extract_tweet(tweet):
+    # extract the stored fields of a tweepy status object. Tweets without
+    # user location and without coordinates are skipped and return None
+    return extract_tweet_json(tweet._json)
+
+def collect_tweets(batch_size=None, background=False, queue_size=10000,
+                   partitioned=False):
+    '''Collect geotagged corona tweets from the twitter search API and store
+    them in the tweets table of geo_tweets_germany.db.
+
+    Collection is incremental: a checkpoint per query and geocode is kept in
+    the database. Runs after a completed crawl only fetch tweets newer than
+    the stored since_id, an interrupted crawl continues below its max_id.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        Number of rows written per bulk insert. None writes every API page
+        with one bulk insert in one transaction. The default is None.
+    background : bool, optional
+        Write rows from a background thread fed by a bounded queue, so paging
+        the API does not wait for database writes. The default is False.
+    queue_size : int, optional
+        Queue bound in rows for background writes. The default is 10000.
+    partitioned : bool, optional
+        Write day-partitioned Parquet files instead of the tweets table, see
+        partition_store. Checkpoints stay in the database. Cannot be
+        combined with background. The default is False.
+
+    Raises
+    ------
+    ValueError
+        If partitioned and background are both set.
+
+    '''
+    if partitioned and background:
+        raise ValueError('background writes are not supported for partitioned storage')
+    api = create_api()
+    db = connect_writer()
     
-    geocode_germany = "51.163361,10.447683,450km"
-    query = "#Corona" or "#Coronavirus" or "#covid19" or "#Coronakrise" or "#sarscov2" or "#SARS-CoV-2" or "#CoronaCrisis" or "#SARS-CoV2" or "Pandemie"
+    # single query collection. Use collect_tweets_concurrent to search all
+    # terms of search_terms
+    query = search_terms[0]
     
     count = 100
     page_count = 0
-    try:
-        for pages in tweepy.Cursor(api.search, q=query, count=count, geocode=geocode_germany, tweet_mode='extended').pages():
-        
-            for tweet in pages:
-                created = tweet.created_at
-                name = tweet.user.screen_name
-                
-                loc = tweet.user.location
-                coords = tweet.coordinates
+    checkpoint = Checkpoint.load(db, query, geocode_germany)
+    cursor_kwargs = checkpoint.cursor_kwargs()
+    if cursor_kwargs:
+        print('resuming from', cursor_kwargs)
+    
+    # the writer flushes buffered rows on leaving the with block, also if
+    # the cursor fails or the collection is interrupted
+    if partitioned:
+        # import here, pyarrow is only needed for partitioned storage
+        from partition_store import PartitionWriter
+        writer = PartitionWriter(batch_size=batch_size, checkpoint=checkpoint, db=db)
+    elif background:
+        writer = BackgroundTweetWriter(db, batch_size=batch_size or 1000,
+                                       checkpoint=checkpoint, maxsize=queue_size)
+    else:
+        writer = TweetWriter(db, batch_size=batch_size, checkpoint=checkpoint)
+    
+    with writer:
+        try:
+            for pages in tweepy.Cursor(api.search, q=query, count=count, geocode=geocode_germany, tweet_mode='extended', **cursor_kwargs).pages():
+            
+                for tweet in pages:
+                    row = extract_tweet(tweet)
+                    if row is not None:
+                        writer.add(row)
                 
-                description = tweet.user.description
-                text = tweet.full_text
+                # write the whole page at once unless a fixed batch size
+                # is configured
+                if batch_size is None:
+                    writer.flush()
                 
-                id_str = tweet.id_str
-                followers = tweet.user.followers_count
-                retweets = tweet.retweet_count
-                user_created = tweet.user.created_at
+                page_count += 1
+                print(page_count, writer.stats())
+                if page_count >= 1000:
+                    break
+            else:
+                # cursor is exhausted: everything up to the newest tweet of
+                # this run is stored, next run only fetches newer tweets
+                writer.drain()
+                checkpoint.complete()
+                with db as tx:
+                    checkpoint.save(tx)
+        except tweepy.TweepError as e:
+            if e == "[{u'message': u'Rate limit exceeded', u'code': 88}]":
+                time.sleep(60*5) #Sleep for 5 minutes
+            else:
+                print(e)
+    
+    print(writer.stats())
+    return writer.rows_written
+
+def _search_term(api, term, checkpoint, limiter, pages_queue, stop, max_pages):
+    # page through the search results of a single term from newest to oldest
+    # and push the extracted rows of every page to pages_queue. Reports
+    # ('done', term, completed) when finished or ('error', term, e) on errors
+    kwargs = checkpoint.cursor_kwargs()
+    page_count = 0
+    try:
+        while not stop.is_set() and page_count < max_pages:
+            limiter.acquire()
+            page = api.search(q=term, count=100, geocode=geocode_germany,
+                              tweet_mode='extended', **kwargs)
+            if not page:
+                pages_queue.put(('done', term, True))
+                return
+            
+            rows = [row for row in map(extract_tweet, page) if row is not None]
+            pages_queue.put(('page', term, rows))
+            
+            kwargs['max_id'] = min(tweet.id for tweet in page) - 1
+            page_count += 1
+        pages_queue.put(('done', term, False))
+    except Exception as e:
+        pages_queue.put(('error', term, e))
+
+def collect_tweets_concurrent(api=None, db=None, terms=search_terms,
+                              max_workers=None, rate=180/900, burst=180,
+                              max_pages=1000):
+    '''Collect tweets for several search terms concurrently.
+
+    Every term is paged in its own thread, all threads share one token bucket
+    so the combined request rate stays within the API limit. Pages are merged
+    on id_str in the calling thread before they are written, every term
+    keeps its own checkpoint.
+
+    Parameters
+    ----------
+    api : tweepy.API, optional
+        API object, any object with a tweepy compatible search method can be
+        used, e.g. a fake API returning canned pages. The default creates
+        an authenticated tweepy API.
+    db : dataset.Database, optional
+        Target database. The default is geo_tweets_germany.db.
+    terms : list of str, optional
+        Search terms. The default is search_terms.
+    max_workers : int, optional
+        Number of collector threads. The default is one thread per term.
+    rate : float, optional
+        Shared API requests per second. The default is 180 requests per 15
+        minutes, the standard search limit.
+    burst : int, optional
+        Number of requests allowed in a burst. The default is 180.
+    max_pages : int, optional
+        Maximum number of pages per term. The default is 1000.
+
+    Returns
+    -------
+    int
+        Number of rows written.
+
+    '''
+    if api is None:
+        api = create_api()
+    if db is None:
+        db = connect_writer()
+    
+    limiter = TokenBucket(rate, burst)
+    pages_queue = queue.Queue()
+    stop = threading.Event()
+    checkpoints = {term: Checkpoint.load(db, term, geocode_germany) for term in terms}
+    seen_ids = set()
+    
+    with ThreadPoolExecutor(max_workers=max_workers or len(terms)) as executor, \
+         TweetWriter(db) as writer:
+        for term in terms:
+            executor.submit(_search_term, api, term, checkpoints[term],
+                            limiter, pages_queue, stop, max_pages)
+        try:
+            active = len(terms)
+            while active:
+                kind, term, payload = pages_queue.get()
+                checkpoint = checkpoints[term]
                 
-                if coords is not None:
-                    coords = json.dumps(coords)
+                if kind == 'page':
+                    # merge on id_str: tweets matching several terms are
+                    # written only once
+                    for row in payload:
+                        if row['id_str'] not in seen_ids:
+                            seen_ids.add(row['id_str'])
+                            writer.add(row)
+                    writer.flush()
                     
-                #if place is not None:
-                    #place = json.dumps(place)
+                    # checkpoint is saved after its rows are committed
+                    checkpoint.update(payload)
+                    with db as tx:
+                        checkpoint.save(tx)
+                    print(term, writer.stats())
+                    continue
                 
-                if loc or coords is not None:
-                    table = db["tweets"]
-                    table.insert(dict(
-                        created=created,
-                        user_name=name,
-                        
-                        user_location=loc,
-                        coordinates=coords,
-                        
-                        user_description=description,
-                        text=text,
-                        
-                        id_str=id_str,
-                        retweet_count=retweets,
-                        user_followers=followers,
-                        user_created=user_created,))
-            
-            page_count += 1
-            print(page_count)
-            if page_count >= 1000:
-                break
-    except tweepy.TweepError as e:
-        if e == "[{u'message': u'Rate limit exceeded', u'code': 88}]":
-            time.sleep(60*5) #Sleep for 5 minutes
-        else:
-            print(e)
-
-collect_tweets()
\ No newline at end of file
+                active -= 1
+                if kind == 'done' and payload:
+                    checkpoint.complete()
+                    with db as tx:
+                        checkpoint.save(tx)
+                elif kind == 'error':
+                    print(term, payload)
+        finally:
+            # ask remaining threads to stop after their current request
+            stop.set()
+    
+    print(writer.stats())
+    return writer.rows_written
+
+if __name__ == '__main__':
+    collect_tweets()
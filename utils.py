@@ -4,6 +4,9 @@ import json
 project_dir = os.path.dirname(os.path.abspath(__file__))
 resources_dir = os.path.join(project_dir, 'resources')
 docs_dir = os.path.join(project_dir, 'docs')
+cache_dir = os.path.join(project_dir, 'cache')
+db_path = os.path.join(project_dir, 'geo_tweets_germany.db')
+partitions_dir = os.path.join(project_dir, 'partitions')
 
 def dump_twitter_credentials_json():
 # enter your twitter keys/secrets as strings in the following fields